@@ -2,15 +2,18 @@
 from typing import Annotated
 from fastapi import Depends, HTTPException, status
 from decouple import config
-from passlib.context import CryptContext
 from fastapi.security import OAuth2PasswordBearer
-from sqlmodel import select
+from sqlmodel import select, update
 from datetime import datetime, timedelta, timezone
+import time
 import jwt
 from jwt.exceptions import InvalidTokenError
-from .schema import Token, TokenData, UserPrivate
+from .schema import Token, TokenData, UserPrivate, Principal
 from .database import SessionDep
 from .models import User
+from .passwords import check_password, hash_password, get_password_hash, verify_password
+from data.cache import LocalCache
+from data.leaderboard import LOCAL_CACHES, publish_invalidation, retry_cache_operation
 
 
 # constants for JWT
@@ -20,22 +23,21 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
 # outh2 scheme for token
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/token")
-pwd_context = CryptContext(schemes=['bcrypt'], deprecated="auto")
 
+# principals cached by token subject so authenticated requests skip the user lookup.
+# entries never outlive the token, and are dropped in every process when the user changes (see invalidate_principal)
+PRINCIPAL_CACHE_TTL = config('PRINCIPAL_CACHE_TTL', default=60, cast=float)
+principal_cache = LocalCache('principals', config('PRINCIPAL_CACHE_SIZE', default=10000, cast=int), PRINCIPAL_CACHE_TTL)
+LOCAL_CACHES['principal'] = principal_cache
 
-# verify password
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
-
-
-# hash password
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+# trust the id and admin claims signed into the token and skip the database entirely.
+# the catch: a deactivated or demoted user keeps their access until the token expires
+AUTH_TRUST_TOKEN_CLAIMS = config('AUTH_TRUST_TOKEN_CLAIMS', default=False, cast=bool)
 
 
 # get user from db
-def get_user(session: SessionDep, email: str) -> UserPrivate | None:
-    result = session.exec(select(User).where(User.email == email))
+async def get_user(session: SessionDep, email: str) -> UserPrivate | None:
+    result = await session.exec(select(User).where(User.email == email))
     user = result.first()
     if user:
         return UserPrivate.from_orm(user)
@@ -43,12 +45,18 @@ def get_user(session: SessionDep, email: str) -> UserPrivate | None:
     
 
 # authenticate user
-def authenticate_user(session: SessionDep, email: str, password: str) -> UserPrivate | bool:
-    user = get_user(session, email)
-    if not user:
+async def authenticate_user(session: SessionDep, email: str, password: str) -> UserPrivate | bool:
+    user = await get_user(session, email)
+    if not user or user.is_active is False:
         return False
-    if not verify_password(password, user.hashed_password):
+    # bcrypt runs in the password process pool so it never blocks the event loop
+    verified, new_hash = await check_password(password, user.hashed_password)
+    if not verified:
         return False
+    # stored hash used an older work factor, swap in the rehash done alongside the verify
+    if new_hash:
+        await session.execute(update(User).where(User.id == user.id).values(hashed_password=new_hash))
+        await session.commit()
     return user
 
 
@@ -64,8 +72,13 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None) -> s
     return encoded_jwt
 
 
+# call whenever a user is deactivated or their details change
+async def invalidate_principal(email: str):
+    await retry_cache_operation(publish_invalidation, 'principal', email)
+
+
 # checks that the token includes the email 
-async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: SessionDep):
+async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: SessionDep) -> Principal:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -79,9 +92,17 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: Se
         token_data = TokenData(email=email)
     except InvalidTokenError:
         raise credentials_exception
-    user = get_user(db, email=token_data.email)
-    if user is None:
-        raise credentials_exception
-    return user
+
+    if AUTH_TRUST_TOKEN_CLAIMS and "uid" in payload and "adm" in payload:
+        return Principal(id=payload["uid"], email=token_data.email, is_admin=payload["adm"])
+
+    principal = principal_cache.get(token_data.email)
+    if principal is None:
+        user = await get_user(db, email=token_data.email)
+        if user is None or user.is_active is False:
+            raise credentials_exception
+        principal = Principal(id=user.id, email=user.email, is_admin=user.is_admin)
+        principal_cache.set(token_data.email, principal, ttl=min(PRINCIPAL_CACHE_TTL, payload["exp"] - time.time()))
+    return principal
 
 
@@ -0,0 +1,159 @@
+import asyncio
+import json
+import logging
+from decouple import config
+from redis.exceptions import RedisError
+from .schema import Period
+from .database import async_session
+from data.leaderboard import r_leaderboard, LEADERBOARD_CHANGES_CHANNEL, retrieve_leaders, get_multiple_usernames, get_leaderboard_version
+from data.postgres import retrieve_multiple_usernames_pg
+
+
+#### LIVE LEADERBOARDS ####
+
+# one broadcaster per (game, period) board with live viewers in this process. submissions publish the game id on
+# LEADERBOARD_CHANGES_CHANNEL, the broadcaster marks itself dirty and at most once per tick reads the top N from redis
+# and fans the diff out to every viewer. a thousand viewers cost the same redis reads as one
+
+
+### 0. Initialization ###
+
+logger = logging.getLogger(__name__)
+
+# a burst of submissions inside one tick goes out as a single diff
+BROADCAST_TICK = config('BROADCAST_TICK', default=1.0, cast=float)
+BROADCAST_TOP_N = config('BROADCAST_TOP_N', default=10, cast=int)
+# messages a viewer can fall behind by before its backlog is replaced with a snapshot
+BROADCAST_QUEUE_SIZE = config('BROADCAST_QUEUE_SIZE', default=16, cast=int)
+# seconds between keepalive comments on idle event streams
+BROADCAST_KEEPALIVE = config('BROADCAST_KEEPALIVE', default=15, cast=float)
+
+
+### 1. BROADCASTER ###
+
+class GameBroadcaster:
+    def __init__(self, game_id: int, period: Period):
+        self.game_id = game_id
+        self.period = period
+        self.subscribers: set[asyncio.Queue] = set()
+        self.dirty = asyncio.Event()
+        # the top N last sent and the snapshot message for it, swapped together so a late joiner and the next diff agree
+        self.entries = None
+        self.snapshot = None
+        self.task = None
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=BROADCAST_QUEUE_SIZE)
+        self.subscribers.add(queue)
+        if self.snapshot is not None:
+            queue.put_nowait(self.snapshot)
+        if self.task is None:
+            # the first read sends the snapshot to everyone waiting for one
+            self.dirty.set()
+            self.task = asyncio.create_task(self.run())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+
+    async def run(self):
+        while True:
+            await self.dirty.wait()
+            self.dirty.clear()
+            try:
+                await self.refresh()
+            except RedisError as e:
+                logger.error(f'Failed to refresh live leaderboard for game {self.game_id}: {e}')
+                self.dirty.set()
+            except Exception as e:
+                logger.error(f'Unexpected error refreshing live leaderboard for game {self.game_id}: {e}')
+            # changes arriving while we sleep are picked up by the next single read
+            await asyncio.sleep(BROADCAST_TICK)
+
+    ## 1.1 one read per tick ##
+
+    async def refresh(self):
+        version = await get_leaderboard_version(self.game_id)
+        leaders = await retrieve_leaders(self.game_id, 0, BROADCAST_TOP_N - 1, self.period)
+        user_ids = [user_id for user_id, _ in leaders]
+        usernames = await get_multiple_usernames(user_ids)
+
+        if None in usernames:
+            missing = [user_ids[i] for i, name in enumerate(usernames) if name is None]
+            async with async_session() as session:
+                found = {str(user.id): user.username for user in await retrieve_multiple_usernames_pg(missing, session) or []}
+            usernames = [name if name is not None else found.get(user_ids[i], user_ids[i]) for i, name in enumerate(usernames)]
+
+        entries = [{"rank": i + 1, "username": usernames[i], "score": score} for i, (_, score) in enumerate(leaders)]
+        if entries == self.entries:
+            # the change was below the top N
+            return
+
+        header = {"game_id": self.game_id, "period": self.period.value, "version": version}
+        previous = self.entries
+        self.entries = entries
+        self.snapshot = json.dumps({"type": "snapshot", **header, "data": entries})
+
+        if previous is None:
+            self.publish(self.snapshot)
+        else:
+            changed = [entry for i, entry in enumerate(entries) if i >= len(previous) or previous[i] != entry]
+            self.publish(json.dumps({"type": "diff", **header, "size": len(entries), "changed": changed}))
+
+    ## 1.2 fan-out ##
+
+    # the message is encoded once and the same string queued for every viewer
+    def publish(self, message: str):
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # slow viewer, drop the backlog and catch it up in one go
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(self.snapshot)
+
+
+### 2. REGISTRY ###
+
+broadcasters: dict[tuple[int, Period], GameBroadcaster] = {}
+
+def subscribe(game_id: int, period: Period = Period.all) -> tuple[GameBroadcaster, asyncio.Queue]:
+    broadcaster = broadcasters.get((game_id, period))
+    if broadcaster is None:
+        broadcaster = broadcasters[(game_id, period)] = GameBroadcaster(game_id, period)
+    return broadcaster, broadcaster.subscribe()
+
+
+# the last viewer leaving stops the broadcaster, the next one starts fresh
+def unsubscribe(broadcaster: GameBroadcaster, queue: asyncio.Queue):
+    broadcaster.unsubscribe(queue)
+    if not broadcaster.subscribers:
+        if broadcaster.task is not None:
+            broadcaster.task.cancel()
+        broadcasters.pop((broadcaster.game_id, broadcaster.period), None)
+
+
+### 3. CHANGE LISTENER ###
+
+# one subscription per process, however many games and viewers
+async def listen_for_leaderboard_changes():
+    while True:
+        pubsub = r_leaderboard.pubsub()
+        try:
+            await pubsub.subscribe(LEADERBOARD_CHANGES_CHANNEL)
+            # changes published while we were not subscribed are lost, so refresh everything once
+            for broadcaster in broadcasters.values():
+                broadcaster.dirty.set()
+            async for message in pubsub.listen():
+                if message['type'] != 'message':
+                    continue
+                game_id = int(message['data'])
+                for broadcaster in list(broadcasters.values()):
+                    if broadcaster.game_id == game_id:
+                        broadcaster.dirty.set()
+        except RedisError as e:
+            logger.error(f'Leaderboard change listener lost redis, resubscribing: {e}')
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
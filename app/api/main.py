@@ -1,15 +1,52 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from .routes import router as all_routes
 from .database import create_db_and_tables
+from .passwords import shutdown_hash_pool
+from data.leaderboard import listen_for_invalidations, drain_retry_queue
+from .broadcast import listen_for_leaderboard_changes
+from data.metrics import observe_request
+from data.logs import setup_logging
+import asyncio
+import time
 import uvicorn 
 
+# before anything logs, so the api process logs through the queue from the start
+setup_logging()
+
 app = FastAPI(title='leaderboard_api', description='an api for a leaderboard service using redis')
 
 app.include_router(all_routes)
 
+# latency per route template, read from GET /metrics
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        route = request.scope.get('route')
+        observe_request(request.method, getattr(route, 'path', 'unmatched'), status_code, time.perf_counter() - started)
+
+background_tasks = set()
+
 @app.on_event("startup")
-def on_strartup():
-    create_db_and_tables()
+async def on_strartup():
+    await create_db_and_tables()
+    # keeps the in-process name caches in step with other api processes
+    background_tasks.add(asyncio.create_task(listen_for_invalidations()))
+    # wakes the live leaderboard broadcasters when a game's board changes
+    background_tasks.add(asyncio.create_task(listen_for_leaderboard_changes()))
+    # redis writes that failed on the request path
+    background_tasks.add(asyncio.create_task(drain_retry_queue()))
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    for task in background_tasks:
+        task.cancel()
+    shutdown_hash_pool()
 
 if __name__ == '__main__':
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -1,4 +1,5 @@
 from sqlmodel import SQLModel, Field, Relationship
+from sqlalchemy import Index
 from typing import Optional
 from typing import List
 from datetime import datetime
@@ -20,11 +21,20 @@ class User(SQLModel, table=True):
 class Game(SQLModel, table=True):
     id : Optional[int] = Field(default=None, primary_key=True)
     name : str = Field(nullable=False, unique=True)
+    # see schema.ScoreMode
+    score_mode : str = Field(default='max', nullable=False)
     game_scores : List["Score"] = Relationship(back_populates="game")
     date_added : datetime = Field(default_factory=datetime.utcnow, nullable=False)
 
 
 class Score(SQLModel, table=True):
+    # (game_id, score) serves top-N and rank reads when redis is down, (user_id, game_id) a user's scores,
+    # (game_id, date_added) the periodic boards and the rebuild. the extra columns make them covering
+    __table_args__ = (
+        Index('ix_score_game_score', 'game_id', 'score', 'user_id'),
+        Index('ix_score_user_game', 'user_id', 'game_id', 'score'),
+        Index('ix_score_game_date', 'game_id', 'date_added', 'user_id', 'score'),
+    )
     id : Optional[int] = Field(default=None, primary_key=True)
     user_id : Optional[int] = Field(default=None, foreign_key="user.id")
     user : Optional["User"] = Relationship(back_populates="score_user")
@@ -34,3 +44,13 @@ class Score(SQLModel, table=True):
     date_added : datetime = Field(default_factory=datetime.utcnow, nullable=False)
 
 
+# each user's current leaderboard score per game, i.e. the all-time board, kept in step with every Score insert
+# (see data/postgres.py upsert_best_scores) so postgres can serve leaderboards while redis is down
+class BestScore(SQLModel, table=True):
+    __table_args__ = (
+        Index('ix_bestscore_game_score', 'game_id', 'score', 'user_id'),
+    )
+    game_id : int = Field(foreign_key="game.id", primary_key=True)
+    user_id : int = Field(foreign_key="user.id", primary_key=True, index=True)
+    score : float = Field(nullable=False)
+    date_added : datetime = Field(default_factory=datetime.utcnow, nullable=False)
@@ -0,0 +1,91 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from decouple import config
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+
+#### PASSWORD HASHING ####
+
+# bcrypt is cpu bound and holds the gil, so it runs in its own process pool.
+# a login storm then queues here instead of stalling every other request on the worker
+
+### 0. SETUP ###
+
+# work factor for new hashes, existing hashes are upgraded on the next successful login
+BCRYPT_ROUNDS = config('BCRYPT_ROUNDS', default=12, cast=int)
+PASSWORD_HASH_WORKERS = config('PASSWORD_HASH_WORKERS', default=os.cpu_count() or 1, cast=int)
+# hash/verify calls allowed in flight (running or queued) per api process before shedding with 503
+PASSWORD_HASH_MAX_PENDING = config('PASSWORD_HASH_MAX_PENDING', default=64, cast=int)
+
+pwd_context = CryptContext(schemes=['bcrypt'], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+hash_pool = None
+pending_hashes = 0
+
+
+### 1. WORKER FUNCTIONS ###
+
+# these run in the pool processes
+
+# verify password
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+# verify password, returning a new hash when the stored one uses an old work factor
+def verify_and_update_password(plain_password: str, hashed_password: str) -> tuple[bool, str | None]:
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+
+# hash password
+def get_password_hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+### 2. POOL ###
+
+# created on first use so importing this module never forks
+def get_hash_pool() -> ProcessPoolExecutor:
+    global hash_pool
+    if hash_pool is None:
+        hash_pool = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS)
+    return hash_pool
+
+
+def shutdown_hash_pool():
+    global hash_pool
+    if hash_pool is not None:
+        hash_pool.shutdown(wait=False, cancel_futures=True)
+        hash_pool = None
+
+
+async def run_in_hash_pool(func, *args):
+    global pending_hashes, hash_pool
+    if pending_hashes >= PASSWORD_HASH_MAX_PENDING:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail='Too many logins in progress, try again shortly',
+                            headers={"Retry-After": "1"})
+    pending_hashes += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(get_hash_pool(), func, *args)
+    except BrokenProcessPool:
+        # a worker died, start a fresh pool for the next call
+        hash_pool = None
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail='Password service restarting, try again shortly',
+                            headers={"Retry-After": "1"})
+    finally:
+        pending_hashes -= 1
+
+
+## 2.1 async entry points ##
+
+async def hash_password(password: str) -> str:
+    return await run_in_hash_pool(get_password_hash, password)
+
+
+async def check_password(plain_password: str, hashed_password: str) -> tuple[bool, str | None]:
+    return await run_in_hash_pool(verify_and_update_password, plain_password, hashed_password)
@@ -0,0 +1,63 @@
+import zlib
+import msgpack
+import orjson
+from fastapi import Request, Response
+
+
+#### FAST RESPONSES ####
+
+# the read-only leaderboard endpoints build their bodies as plain dicts and lists that are already in their final shape.
+# handing fastapi a Response skips the jsonable_encoder walk over every row and any response_model re-validation,
+# and orjson / msgpack encode the rows in C. clients get msgpack by sending Accept: application/msgpack.
+# streamed bodies (the leaderboard export) are gzipped here as they go when the client accepts it
+
+
+### 1. NEGOTIATION ###
+
+JSON_MEDIA_TYPE = 'application/json'
+MSGPACK_MEDIA_TYPE = 'application/msgpack'
+MSGPACK_ACCEPT = {MSGPACK_MEDIA_TYPE, 'application/x-msgpack', 'application/vnd.msgpack'}
+
+# json unless the client lists a msgpack type, q-values are not weighed
+def negotiate(request: Request) -> str:
+    for media_range in request.headers.get('accept', '').split(','):
+        if media_range.split(';', 1)[0].strip().lower() in MSGPACK_ACCEPT:
+            return MSGPACK_MEDIA_TYPE
+    return JSON_MEDIA_TYPE
+
+
+### 2. ENCODING ###
+
+def encode(data, media_type: str = JSON_MEDIA_TYPE) -> bytes:
+    if media_type == MSGPACK_MEDIA_TYPE:
+        return msgpack.packb(data, use_bin_type=True)
+    return orjson.dumps(data)
+
+
+# the body differs by Accept, so shared caches must key on it too
+def encoded_response(body: bytes, media_type: str, headers: dict | None = None) -> Response:
+    return Response(content=body, media_type=media_type, headers={**(headers or {}), "Vary": "Accept"})
+
+
+def fast_response(request: Request, data, headers: dict | None = None) -> Response:
+    media_type = negotiate(request)
+    return encoded_response(encode(data, media_type), media_type, headers)
+
+
+### 3. STREAMING ###
+
+def accepts_gzip(request: Request) -> bool:
+    return any(coding.split(';', 1)[0].strip().lower() == 'gzip'
+               for coding in request.headers.get('accept-encoding', '').split(','))
+
+
+# one gzip member over the whole stream, flushed after every chunk so rows reach the client as they are read
+async def gzip_stream(chunks):
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    try:
+        async for chunk in chunks:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    finally:
+        # a client that disconnects closes this stream, pass that on so the source can clean up
+        await chunks.aclose()
@@ -1,23 +1,48 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+import asyncio
 from typing import List
 from fastapi.security import OAuth2PasswordRequestForm
 from typing import Annotated
-from datetime import timedelta
+from datetime import timedelta, datetime
 import logging
-from .database import SessionDep
-from .auth import authenticate_user, create_access_token, get_password_hash, get_current_user
-from .schema import Token, UserInput, UserPublic, ScorePublic, ScoreInput, SingleRankWithScore, GameLookUp, GameID, GameIDInput, MultipleRanks, TopPlayerList
+import json
+import base64
+import csv
+import io
+from .database import SessionDep, async_session
+from .broadcast import subscribe, unsubscribe, BROADCAST_KEEPALIVE
+from .responses import negotiate, encode, encoded_response, fast_response, accepts_gzip, gzip_stream, MSGPACK_MEDIA_TYPE
+from .auth import authenticate_user, create_access_token, hash_password, get_current_user, invalidate_principal
+from .schema import Token, UserInput, UserUpdate, UserPublic, ScorePublic, ScoreInput, ScoreBatchItem, ScoreBatchInput, ScoreBatchPublic, SingleRankWithScore, ScoreDistribution, ScorePercentile, ExportFormat, Period, GameLookUp, GameID, GameIDInput, MultipleRanks, TopPlayerList, Principal
 from .models import User, Score, Game
-from data.leaderboard import retry_submit_score, retrieve_ranking, retrieve_leaders, retry_set_user_cache, retry_set_game_cache, get_game_cache, get_multiple_usernames, add_multiple_usernames, user_data_all_games
-from data.postgres import get_player_info
+from data.leaderboard import retry_submit_score, retry_submit_score_batch, retry_submit_score_write_behind, retrieve_ranking, retrieve_leaders, retrieve_leaders_no_score, retrieve_neighbours, retrieve_leaders_after, export_leaders, get_score_histogram, histogram_rank, retrieve_score_and_histogram, retry_set_user_cache, retry_bump_user_game_versions, retry_set_game_cache, retry_set_game_mode, get_game_mode, get_game_cache, get_multiple_game_names, get_multiple_usernames, add_multiple_usernames, user_data_all_games, get_leaderboard_version, leaderboard_key, redis_available, get_cached_report, set_cached_report, invalidate_player_profile
+from data.cache import LocalCache
+from data.connections import pool_stats
+from data.metrics import render_metrics
+from data.postgres import get_player_info, upsert_best_scores, pg_retrieve_leaders, pg_retrieve_ranking, pg_user_data_all_games
 from sqlmodel import select
-from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError, OperationalError, SQLAlchemyError
 from redis.exceptions import ConnectionError, RedisError
+from decouple import config
 import copy
 
 
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# 'sync' commits each score to postgres before redis.
+# 'write_behind' only writes redis (leaderboard + score stream) and leaves postgres to the flusher in data/synchronisation.py
+SCORE_WRITE_MODE = config('SCORE_WRITE_MODE', default='sync')
+
+# hard cap on rows in one leaderboard response, and on players either side of a user in the around view
+LEADERBOARD_MAX_PAGE_SIZE = config('LEADERBOARD_MAX_PAGE_SIZE', default=100, cast=int)
+LEADERBOARD_MAX_RADIUS = config('LEADERBOARD_MAX_RADIUS', default=25, cast=int)
+
+# serialised leaderboard pages, keyed on the game's version so any score write retires them
+leaderboard_page_cache = LocalCache('leaderboard_pages', config('PAGE_CACHE_SIZE', default=1000, cast=int),
+                                    config('PAGE_CACHE_TTL', default=60, cast=float))
+
 ### 0 SETUP ###
 
 
@@ -28,14 +53,7 @@ router = APIRouter()
 
 ## 0.2 logger ##
 
-# initialize logger 
-logging.basicConfig(level=logging.INFO,
-                    format="%(asctime)s - %(levelname)s - %(message)s",
-                    handlers=[
-        logging.StreamHandler(),  # Logs to console
-        logging.FileHandler("app.log")  # Logs to file
-    ])
-
+# handlers are set up once per process in data/logs.py
 logger = logging.getLogger(__name__)
 
 
@@ -46,28 +64,28 @@ def log_and_raise_error(message: str, status_code: int = 500):
 
 
 ## 0.4 read from postgres if operation (redis-based) does not return the value 
-def read_db_value(operation, cache_add, session, id, model, attribute: str):
+async def read_db_value(operation, cache_add, session, id, model, attribute: str):
     try:
-        value = operation(id)
+        # straight to postgres while redis is down
+        value = await operation(id) if redis_available() else None
         if not value:
-            print('cache miss')
             raise ValueError('Cache miss')
         
     except ValueError as e:
-        logger.error(f'cache miss for {model.__name__}: {id}')
-        data = session.get(model, id)
+        logger.debug(f'cache miss for {model.__name__}: {id}')
+        data = await session.get(model, id)
         value = getattr(data, attribute, None) if data else None
         #add to cache
-        cache_add(data, id)
-        print('cache add')
+        if value and redis_available():
+            await cache_add(value, id)
 
     except Exception as e:
         logger.error(f'Failed to read {model.__name__} from redis: {e}')
-        data = session.get(model, id)
+        data = await session.get(model, id)
         value = getattr(data, attribute, None) if data else None
         #add to cache
-        cache_add(data, id)
-        print('cache add')
+        if value and redis_available():
+            await cache_add(value, id)
 
     if not value:
         log_and_raise_error(f"Failed to read game from cache or db for game_id {id}")
@@ -75,10 +93,11 @@ def read_db_value(operation, cache_add, session, id, model, attribute: str):
 
 
 ## 0.5 lookup various users from postgres
-def retrieve_multiple_usernames_pg(list_of_ids : List[str], session):
+async def retrieve_multiple_usernames_pg(list_of_ids : List[str], session):
     # get data from postgres
     try:
-        data = session.exec(select(User).where(User.id.in_(list_of_ids))).all()
+        # ids from redis are strings, asyncpg needs them typed
+        data = (await session.exec(select(User).where(User.id.in_([int(id) for id in list_of_ids])))).all()
     except Exception as e:
         logger.error(f"Failure to read data from db: {e} for users: {list_of_ids}")
         return []
@@ -94,13 +113,15 @@ def retrieve_multiple_usernames_pg(list_of_ids : List[str], session):
         username = getattr(item, 'username', None)
         id_username_data.append((id, username))
         
-    write_multiple_usernames_redis(id_username_data)
+    await write_multiple_usernames_redis(id_username_data)
     return id_username_data
 
 ## 0.6 write multiple users to redis user cache ##
-def write_multiple_usernames_redis(user_data):
+async def write_multiple_usernames_redis(user_data):
+    if not redis_available():
+        return []
     try:
-        redis_response = add_multiple_usernames(user_data)
+        redis_response = await add_multiple_usernames(user_data)
         return redis_response
     except RedisError as e:
         logger.error(f"Failure to write data to redis: {e} for users: {user_data}")
@@ -112,6 +133,101 @@ def check_user(current_user : int , user_id : int):
     if current_user != user_id:
         raise HTTPException(status_code=401, detail=f'you do not have permission to view this resource. {current_user}')
 
+
+## 0.8 conditional requests
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]
+
+## 0.9 usernames for a list of user ids, cache first then postgres ##
+async def resolve_usernames(user_ids, session):
+    usernames = await read_with_fallback(lambda: get_multiple_usernames(user_ids), lambda: no_usernames(user_ids))
+
+    # add missing usernames to the cache
+    if None in usernames:
+        #look up the missing usernames
+        missing_usernames = [user_ids[i] for i in range(len(usernames)) if usernames[i] is None]
+        missing_data = await retrieve_multiple_usernames_pg(missing_usernames, session)
+
+        # Step 1: Create a dictionary from the list of tuples
+        new_usernames_dict = {str(user_id): username for user_id, username in missing_data}
+
+        # Step 2: fill the gaps, falling back to the id if the user is not in postgres either
+        usernames = [
+            usernames[i] if usernames[i] is not None else new_usernames_dict.get(user_ids[i], user_ids[i])
+            for i in range(len(usernames))
+        ]
+    return usernames
+
+
+## 0.10 postgres fallback ##
+
+# runs the redis read unless the main node's circuit is open, otherwise (or if it fails) the postgres one.
+# both are zero-argument callables returning awaitables
+async def read_with_fallback(redis_read, pg_read):
+    if redis_available():
+        try:
+            return await redis_read()
+        except RedisError as e:
+            logger.error(f'Redis read failed, serving from postgres: {e}')
+    return await pg_read()
+
+# every name counts as a cache miss, resolve_usernames then reads them all from postgres
+async def no_usernames(user_ids):
+    return [None] * len(user_ids)
+
+
+## 0.11 percentile from a game's histogram ##
+def percentile_response(game_name: str, score_mode: str, score: float, edges, buckets):
+    rank, total = histogram_rank(edges, buckets, score, score_mode)
+    if rank is None:
+        return {"game": game_name, "score": score, "approximate_rank": None, "total": 0, "percentile": None, "top_percent": None}
+    return {"game": game_name, "score": score, "approximate_rank": rank, "total": total,
+            "percentile": round(100 * (total - rank) / total, 2),
+            "top_percent": round(100 * rank / total, 2)}
+
+
+## 0.12 leaderboard cursors ##
+
+# opaque to clients: the score and member of the last entry on the page
+def encode_cursor(score: float, member: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([score, member]).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: str) -> tuple[float, str]:
+    try:
+        score, member = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return float(score), str(member)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+
+
+## 0.13 leaderboard export rows ##
+
+EXPORT_CSV_HEADER = b'rank,user_id,username,score\r\n'
+
+# one chunk of (rank, user_id, score) with its usernames, as ndjson lines or csv rows
+def export_rows(chunk, usernames, format: ExportFormat) -> bytes:
+    if format == ExportFormat.csv:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows((rank, member, username, score) for (rank, member, score), username in zip(chunk, usernames))
+        return buffer.getvalue().encode()
+    return b''.join(encode({"rank": rank, "user_id": member, "username": username, "score": score}) + b'\n'
+                    for (rank, member, score), username in zip(chunk, usernames))
+
+
+## 0.14 ids that exist ##
+
+# which of the ids are rows of the model: the name cache first, then one IN query for whatever it did not have
+async def existing_ids(ids, cache_lookup, model, session) -> set[int]:
+    ids = list(dict.fromkeys(ids))
+    names = await read_with_fallback(lambda: cache_lookup(ids), lambda: no_usernames(ids))
+    found = {id for id, name in zip(ids, names) if name is not None}
+    missing = [id for id in ids if id not in found]
+    if missing:
+        found.update((await session.exec(select(model.id).where(model.id.in_(missing)))).all())
+    return found
+
 ## --------------------##
 ### 1. ENDPOINTS ###
 ## --------------------##
@@ -123,22 +239,24 @@ def check_user(current_user : int , user_id : int):
 # POST
 # register endpoint
 @router.post("/users/register/", response_model=UserPublic)
-def create_user(user: UserInput, session: SessionDep):
+async def create_user(user: UserInput, session: SessionDep):
     #get hashed password
     try:
-        hashed_password = get_password_hash(user.plain_password)
+        hashed_password = await hash_password(user.plain_password)
+    except HTTPException:
+        raise
     except Exception as e:
         log_and_raise_error(f"Error hashing password: {e}", 400)
     
     #create new User instance
     try: 
-        new_user = User(email = user.email, username=user.username, hashed_password=hashed_password, is_admin=user.is_admin)
+        new_user = User(email = user.email, username=user.username, country=user.country, hashed_password=hashed_password, is_admin=user.is_admin)
         session.add(new_user)
-        session.commit()
-        session.refresh(new_user)
+        await session.commit()
+        await session.refresh(new_user)
         
     except IntegrityError as e:
-        session.rollback()
+        await session.rollback()
         log_and_raise_error(f"User with this username/email already exists: {e}", 400)
     except RedisError as e:
         log_and_raise_error(f"Error adding to cache : {e}", 400)
@@ -146,11 +264,51 @@ def create_user(user: UserInput, session: SessionDep):
         log_and_raise_error(f"Error adding user to db: {e}", 400)
     
     # set id -> username in cache
-    retry_set_user_cache(new_user.username, new_user.id)
+    await retry_set_user_cache(new_user.username, new_user.id)
 
     return new_user
 
 
+## 1.1.1 update a profile ##
+
+# /users/{user_id}
+# PATCH
+# username and country, by the user or an admin. the cached name and report profile are refreshed
+# pg
+@router.patch("/users/{user_id}", response_model=UserPublic)
+async def update_user(user_id: int, update: UserUpdate,
+                      current_user: Annotated[Principal, Depends(get_current_user)],
+                      session: SessionDep):
+    if current_user.id != user_id and current_user.is_admin != True:
+        raise HTTPException(status_code=401, detail=f'you do not have permission to view this resource. {current_user.id}')
+
+    user = await session.get(User, user_id)
+    if user is None:
+        raise HTTPException(status_code=404, detail='User not found')
+
+    for field, value in update.model_dump(exclude_none=True).items():
+        setattr(user, field, value)
+    try:
+        session.add(user)
+        await session.commit()
+        await session.refresh(user)
+    except IntegrityError as e:
+        await session.rollback()
+        log_and_raise_error(f"User with this username already exists: {e}", 400)
+
+    # reports cached before the change keep the old profile until they expire (REPORT_CACHE_TTL)
+    try:
+        await invalidate_player_profile(user.id)
+    except RedisError as e:
+        logger.error(f"Failed to drop the cached profile for user {user_id}: {e}")
+    if update.username is not None:
+        await retry_set_user_cache(user.username, user.id)
+        # after the name cache, so a page rebuilt under the new version has the new name
+        await retry_bump_user_game_versions(user.id)
+
+    return user
+
+
 ## 1.2 login ##
 
 # /login
@@ -161,8 +319,7 @@ async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
     session: SessionDep
 ) -> Token:
-    print( form_data.username)
-    user = authenticate_user(session, form_data.username, form_data.password)
+    user = await authenticate_user(session, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -171,7 +328,7 @@ async def login_for_access_token(
         )
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
+        data={"sub": user.email, "uid": user.id, "adm": bool(user.is_admin)}, expires_delta=access_token_expires
     )
     return Token(access_token=access_token, token_type="bearer")
 
@@ -183,10 +340,10 @@ async def login_for_access_token(
 # ids for games
 # postgres
 @router.get("/games", response_model=GameLookUp)
-def all_game_ids(session : SessionDep):
+async def all_game_ids(session : SessionDep):
     try:
-        games = session.exec(select(Game)).all()
-        return GameLookUp(games = [GameID(id = game.id, name=game.name) for game in games])
+        games = (await session.exec(select(Game))).all()
+        return GameLookUp(games = [GameID(id = game.id, name=game.name, score_mode=game.score_mode) for game in games])
     except Exception as e:
         log_and_raise_error(f"Error when retrieving data: {e}", 500)
 
@@ -200,26 +357,28 @@ def all_game_ids(session : SessionDep):
 # TODO limit to admin staff. 
 
 @router.post("/games", response_model=GameID)
-def add_game(game: GameIDInput, 
+async def add_game(game: GameIDInput, 
              session : SessionDep,
-             current_user: Annotated[User, Depends(get_current_user)]):
+             current_user: Annotated[Principal, Depends(get_current_user)]):
     
     if current_user.is_admin != True:
         raise HTTPException(status_code=401, detail=f'You do not have permission to view this resource.')
     try:
-        new_game = Game(name = game.name)
+        new_game = Game(name = game.name, score_mode = game.score_mode.value)
         session.add(new_game)
-        session.commit()
-        session.refresh(new_game)
+        await session.commit()
+        await session.refresh(new_game)
         
     except IntegrityError as e:
-        session.rollback()
+        await session.rollback()
         log_and_raise_error(f"Game with this name already exists: {e}", 400)
     except Exception as e:
         log_and_raise_error(f"Error adding user to db: {e}", 500)
     
     # add id -> name to cache
-    retry_set_game_cache(new_game.name, new_game.id)
+    await retry_set_game_cache(new_game.name, new_game.id)
+    # read by the submit script
+    await retry_set_game_mode(new_game.id, new_game.score_mode)
 
     return new_game
 
@@ -231,19 +390,98 @@ def add_game(game: GameIDInput,
 # score submission 
 # redis & pg
 @router.post("/users/{user_id}/scores", response_model=ScorePublic)
-def submit_scores(user_id : int, score: ScoreInput, session: SessionDep):
+async def submit_scores(user_id : int, score: ScoreInput, session: SessionDep):
+    if SCORE_WRITE_MODE == 'write_behind':
+        # nothing checks the ids before the flusher, so an unknown game or user is refused here rather than
+        # put on the boards and then dead-lettered
+        try:
+            if not await existing_ids([score.game_id], get_multiple_game_names, Game, session):
+                raise HTTPException(status_code=404, detail=f"Unknown game {score.game_id}")
+            if not await existing_ids([user_id], get_multiple_usernames, User, session):
+                raise HTTPException(status_code=404, detail=f"Unknown user {user_id}")
+        except SQLAlchemyError as e:
+            log_and_raise_error(f"Error checking score ids: {e}", 500)
+        new_score = ScoreBatchItem(user_id=user_id, game_id=score.game_id, score=score.score)
+        date_added = datetime.utcnow()
+        try:
+            [(submission, stream_id)] = await retry_submit_score_write_behind([new_score], date_added)
+        except RedisError as e:
+            log_and_raise_error(f"Error adding score to stream: {e}", 503)
+        return {**new_score.model_dump(), **submission, "date_added": date_added, "stream_id": stream_id}
+
     try:
-        # add to postgres
+        # add to postgres, with the user's best score for the fallback leaderboard
         new_score = Score(user_id = user_id, game_id=score.game_id, score=score.score)
         session.add(new_score)
-        session.commit()
-        session.refresh(new_score)
+        await session.flush()
+        await upsert_best_scores(session, [new_score.model_dump()])
+        await session.commit()
+        await session.refresh(new_score)
     except Exception as e:
         log_and_raise_error(f"Error adding score to db: {e}", 500)
-     # add to redis
-    retry_submit_score(score, user_id)
+     # add to redis, the new rank comes back with the write. if redis fails it is retried in the background
+    # and the response goes out without the rank
+    submission = await retry_submit_score(score, user_id, new_score.date_added)
     
-    return new_score
+    return {**new_score.model_dump(), **(submission or {})}
+
+
+## 1.5.1 submit a batch of scores ##
+
+# /scores/batch
+# POST
+# end of match submission from game servers
+# redis & pg
+@router.post("/scores/batch", response_model=ScoreBatchPublic)
+async def submit_scores_batch(batch: ScoreBatchInput, session: SessionDep):
+    date_added = datetime.utcnow()
+    rows = [{"user_id": item.user_id, "game_id": item.game_id, "score": item.score, "date_added": date_added}
+            for item in batch.scores]
+
+    # a row naming a game or user that does not exist would fail the whole insert on its foreign key, so those rows
+    # are reported back on their own and the rest go ahead
+    try:
+        game_ids = await existing_ids([item.game_id for item in batch.scores], get_multiple_game_names, Game, session)
+        user_ids = await existing_ids([item.user_id for item in batch.scores], get_multiple_usernames, User, session)
+    except SQLAlchemyError as e:
+        log_and_raise_error(f"Error checking score batch ids: {e}", 500)
+    results = [None] * len(rows)
+    for i, item in enumerate(batch.scores):
+        if item.game_id not in game_ids:
+            results[i] = {**rows[i], "status": 404, "error": f"Unknown game {item.game_id}", "leaderboard_updated": False}
+        elif item.user_id not in user_ids:
+            results[i] = {**rows[i], "status": 404, "error": f"Unknown user {item.user_id}", "leaderboard_updated": False}
+    valid = [i for i, result in enumerate(results) if result is None]
+    valid_rows = [rows[i] for i in valid]
+    valid_scores = [batch.scores[i] for i in valid]
+    if not valid:
+        return {"results": results}
+
+    if SCORE_WRITE_MODE == 'write_behind':
+        try:
+            submissions = await retry_submit_score_write_behind(valid_scores, date_added)
+        except RedisError as e:
+            log_and_raise_error(f"Error adding score batch to stream: {e}", 503)
+        for i, row, (submission, stream_id) in zip(valid, valid_rows, submissions):
+            results[i] = {**row, **submission, "stream_id": stream_id, "leaderboard_updated": True}
+        return {"results": results}
+
+    try:
+        # add to postgres as one multi-row insert, ids come back in the order submitted
+        result = await session.execute(insert(Score).returning(Score.id, sort_by_parameter_order=True), valid_rows)
+        new_ids = result.scalars().all()
+        await upsert_best_scores(session, valid_rows)
+        await session.commit()
+    except Exception as e:
+        await session.rollback()
+        log_and_raise_error(f"Error adding score batch to db: {e}", 500)
+
+    # add to redis, one pipeline for the whole batch. retried in the background if redis fails
+    submissions = await retry_submit_score_batch(valid_scores, date_added) or [None] * len(valid_rows)
+
+    for i, row, new_id, submission in zip(valid, valid_rows, new_ids, submissions):
+        results[i] = {**row, **(submission or {}), "id": new_id, "leaderboard_updated": submission is not None}
+    return {"results": results}
 
 
 
@@ -255,14 +493,47 @@ def submit_scores(user_id : int, score: ScoreInput, session: SessionDep):
 # redis
 
 @router.get("/games/leaderboard/{game_id}")
-def leaderboard_single_game(game_id: int,
+async def leaderboard_single_game(game_id: int,
+                            request: Request,
                             session : SessionDep,
                         start: int = Query(0, ge=0),
-                        end: int = Query(9, ge=4)):
-    # retrieve from redis
+                        end: int = Query(9, ge=4),
+                        period: Period = Query(Period.all)):
+    if end < start or end - start + 1 > LEADERBOARD_MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f'Pages hold at most {LEADERBOARD_MAX_PAGE_SIZE} rows, use /games/leaderboard/{game_id}/page to scroll further')
+
+    # the version changes on every write to the game, so together with the board and range it identifies the page
+    version = await read_with_fallback(lambda: get_leaderboard_version(game_id), no_version)
+    if version is None:
+        # redis is down, no version to cache or validate against
+        return fast_response(request, await build_leaderboard_page(game_id, start, end, period, session))
+    # each encoding is its own representation, with its own tag and cache entry
+    media_type = negotiate(request)
+    etag = f'"{leaderboard_key(game_id, period)}:{version}:{start}:{end}{":msgpack" if media_type == MSGPACK_MEDIA_TYPE else ""}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    # client already has this page
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={**headers, "Vary": "Accept"})
+
+    body = leaderboard_page_cache.get(etag)
+    if body is None:
+        body = encode(await build_leaderboard_page(game_id, start, end, period, session), media_type)
+        leaderboard_page_cache.set(etag, body)
+
+    return encoded_response(body, media_type, headers)
+
+
+async def no_version():
+    return None
+
+
+async def build_leaderboard_page(game_id: int, start: int, end: int, period: Period, session):
+    # retrieve from redis, or postgres while it is down
     try:
-        data = retrieve_leaders(game_id, start, end)
-    except RedisError as e:
+        data = await read_with_fallback(lambda: retrieve_leaders(game_id, start, end, period),
+                                        lambda: pg_retrieve_leaders(session, game_id, start, end, period))
+    except SQLAlchemyError as e:
         log_and_raise_error(f'Failed to fetch leaders for game {game_id} : {e}', 500)
 
     # if no data, return early
@@ -273,29 +544,11 @@ def leaderboard_single_game(game_id: int,
     # selects the user ids of the leaders
     user_ids = [entry[0] for entry in data]
     # gets the multiple usernames
-    usernames = get_multiple_usernames(user_ids)
-    print(usernames)
-    
-    # add missing usernames to the cache
-    if None in usernames:
-        #look up the missing usernames
-        missing_usernames = [user_ids[i] if usernames[i] is None else None for i in range(len(usernames))]
-        missing_data = retrieve_multiple_usernames_pg(missing_usernames)
-        # prepare data
-        username_or_id = [user_ids[i] if usernames[i] == None else usernames[i] for i in range(len(usernames))]
-
-        # Step 1: Create a dictionary from the list of tuples
-        new_usernames_dict = {user_id: username for user_id, username in missing_data}
-
-        # Step 2: Update the missing_usernames list
-        usernames = [
-            new_usernames_dict.get(str(user_id), user_id) if isinstance(user_id, int) else user_id
-            for user_id in username_or_id
-        ]
+    usernames = await resolve_usernames(user_ids, session)
 
 
     # lookup game name using game id
-    game_name = read_db_value(get_game_cache, retry_set_game_cache, session, game_id, Game, 'name')
+    game_name = await read_db_value(get_game_cache, retry_set_game_cache, session, game_id, Game, 'name')
 
     # construct response
     response_data = []
@@ -314,6 +567,185 @@ def leaderboard_single_game(game_id: int,
     return {"game" :game_name, "data": response_data}
 
 
+## 1.6.1 deep pages by cursor ##
+
+# games/leaderboard/{game_id}/page
+# GET
+# keyset pagination: pass next_cursor from the previous page to continue, each page costs O(log n + size) however deep
+# redis
+@router.get("/games/leaderboard/{game_id}/page")
+async def leaderboard_page_by_cursor(game_id: int,
+                                     request: Request,
+                                     session : SessionDep,
+                                     cursor: str | None = Query(None),
+                                     limit: int = Query(10, ge=1),
+                                     period: Period = Query(Period.all)):
+    limit = min(limit, LEADERBOARD_MAX_PAGE_SIZE)
+    after = decode_cursor(cursor) if cursor else None
+
+    try:
+        leaders = await retrieve_leaders_after(game_id, after, limit, period)
+    except RedisError as e:
+        log_and_raise_error(f'Failed to fetch leaders for game {game_id} : {e}', 500)
+
+    usernames = await resolve_usernames([member for _, member, _ in leaders], session)
+    game_name = await read_db_value(get_game_cache, retry_set_game_cache, session, game_id, Game, 'name')
+
+    # a short page is the last one
+    next_cursor = encode_cursor(leaders[-1][2], leaders[-1][1]) if len(leaders) == limit else None
+    return fast_response(request, {"game": game_name,
+                                   "data": [{"rank": rank, "username": username, "score": score}
+                                            for (rank, _, score), username in zip(leaders, usernames)],
+                                   "next_cursor": next_cursor})
+
+
+## 1.6.2 players around a user ##
+
+# users/{user_id}/ranking/{game_id}/around
+# GET
+# the user's rank with up to radius players above and below, in one redis round trip
+# redis
+@router.get("/users/{user_id}/ranking/{game_id}/around")
+async def user_neighbours_single_game(user_id: int, game_id: int,
+                                      request: Request,
+                                      current_user: Annotated[Principal, Depends(get_current_user)],
+                                      session : SessionDep,
+                                      radius: int = Query(5, ge=0),
+                                      period: Period = Query(Period.all)):
+    # ensure current user is asking about their own resource
+    check_user(current_user.id, user_id)
+    radius = min(radius, LEADERBOARD_MAX_RADIUS)
+
+    try:
+        rank, neighbours = await retrieve_neighbours(user_id, game_id, radius, period)
+    except RedisError as e:
+        log_and_raise_error(f'Failed to fetch neighbours for user {user_id} in game {game_id} : {e}', 500)
+
+    if rank is None:
+        raise HTTPException(status_code=404, detail='Could not find the rank of the user for this game. Please check the provided details.')
+
+    usernames = await resolve_usernames([member for _, member, _ in neighbours], session)
+    game_name = await read_db_value(get_game_cache, retry_set_game_cache, session, game_id, Game, 'name')
+
+    return fast_response(request, {"game": game_name,
+                                   "rank": rank,
+                                   "data": [{"rank": entry_rank, "username": username, "score": score}
+                                            for (entry_rank, _, score), username in zip(neighbours, usernames)]})
+
+
+## 1.6.3 score distribution ##
+
+# games/{game_id}/distribution
+# GET
+# players per score bucket on the all-time board, read from the histogram the submit script maintains
+# redis
+@router.get("/games/{game_id}/distribution", response_model=ScoreDistribution)
+async def score_distribution(game_id: int, session : SessionDep):
+    try:
+        edges, buckets = await get_score_histogram(game_id)
+    except RedisError as e:
+        log_and_raise_error(f'Failed to fetch the score histogram for game {game_id} : {e}', 500)
+
+    game_name = await read_db_value(get_game_cache, retry_set_game_cache, session, game_id, Game, 'name')
+    bounds = [None] + edges + [None]
+    return {"game": game_name,
+            "total": sum(buckets),
+            "buckets": [{"min": bounds[i], "max": bounds[i + 1], "count": count} for i, count in enumerate(buckets)]}
+
+
+## 1.6.4 percentile of a score ##
+
+# games/{game_id}/percentile
+# GET
+# approximate rank and percentile a score would have on the all-time board, without touching the sorted set
+# redis
+@router.get("/games/{game_id}/percentile", response_model=ScorePercentile)
+async def score_percentile(game_id: int, session : SessionDep, score: float = Query(...)):
+    try:
+        edges, buckets = await get_score_histogram(game_id)
+        score_mode = await get_game_mode(game_id)
+    except RedisError as e:
+        log_and_raise_error(f'Failed to fetch the score histogram for game {game_id} : {e}', 500)
+
+    game_name = await read_db_value(get_game_cache, retry_set_game_cache, session, game_id, Game, 'name')
+    return percentile_response(game_name, score_mode, score, edges, buckets)
+
+
+# users/{user_id}/ranking/{game_id}/percentile
+# GET
+# the user's "top x%" on the all-time board
+# redis
+@router.get("/users/{user_id}/ranking/{game_id}/percentile", response_model=ScorePercentile)
+async def user_percentile(user_id: int, game_id: int,
+                          current_user: Annotated[Principal, Depends(get_current_user)],
+                          session : SessionDep):
+    # ensure current user is asking about their own resource
+    check_user(current_user.id, user_id)
+
+    try:
+        result = await retrieve_score_and_histogram(user_id, game_id)
+        score_mode = await get_game_mode(game_id)
+    except RedisError as e:
+        log_and_raise_error(f'Failed to fetch the score histogram for game {game_id} : {e}', 500)
+
+    if result is None:
+        raise HTTPException(status_code=404, detail='Could not find the rank of the user for this game. Please check the provided details.')
+
+    game_name = await read_db_value(get_game_cache, retry_set_game_cache, session, game_id, Game, 'name')
+    return percentile_response(game_name, score_mode, *result)
+
+
+## 1.6.5 full leaderboard export ##
+
+# games/{game_id}/leaderboard/export
+# GET
+# admin route for analytics: the whole board as ndjson or csv, read and sent a chunk at a time so memory does not grow
+# with the board. gzipped when the client accepts it. snapshot=true exports a copy of the board taken at the start
+# redis, pg for usernames missing from the cache
+@router.get('/games/{game_id}/leaderboard/export')
+async def export_leaderboard(game_id: int, request: Request,
+                             current_user: Annotated[Principal, Depends(get_current_user)],
+                             format: ExportFormat = Query(ExportFormat.ndjson),
+                             period: Period = Query(Period.all),
+                             snapshot: bool = Query(False)):
+    if current_user.is_admin != True:
+        raise HTTPException(status_code=401, detail='You do not have permission to view this resource.')
+
+    chunks = export_leaders(game_id, period, snapshot)
+    # the first read happens before the response starts, so a redis failure can still get a proper status
+    try:
+        first = await anext(chunks, None)
+    except RedisError as e:
+        await chunks.aclose()
+        log_and_raise_error(f'Failed to export the leaderboard for game {game_id} : {e}', 503)
+
+    # the request's session is closed once the response starts, the stream opens its own
+    async def rows():
+        try:
+            if format == ExportFormat.csv:
+                yield EXPORT_CSV_HEADER
+            chunk = first
+            async with async_session() as session:
+                while chunk is not None:
+                    usernames = await resolve_usernames([member for _, member, _ in chunk], session)
+                    yield export_rows(chunk, usernames, format)
+                    chunk = await anext(chunks, None)
+        except RedisError as e:
+            # too late for an error status, the client gets a truncated export
+            logger.error(f'Leaderboard export for game {game_id} failed part way: {e}')
+        finally:
+            await chunks.aclose()
+
+    filename = f'leaderboard-{game_id}-{period.value}.{format.value}'
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"', "Vary": "Accept-Encoding"}
+    body = rows()
+    if accepts_gzip(request):
+        headers["Content-Encoding"] = "gzip"
+        body = gzip_stream(body)
+    media_type = 'text/csv' if format == ExportFormat.csv else 'application/x-ndjson'
+    return StreamingResponse(body, media_type=media_type, headers=headers)
+
+
 ## 1.7 user's ranking for a game ##
 
 # users/{user_id}/ranking/{game_id}
@@ -321,27 +753,25 @@ def leaderboard_single_game(game_id: int,
 # user's rankings for a single game
 # redis
 @router.get("/users/{user_id}/ranking/{game_id}")
-def user_score_single_game(user_id: int, game_id,
-                           current_user: Annotated[User, Depends(get_current_user)],
-                           session : SessionDep) -> SingleRankWithScore:
+async def user_score_single_game(user_id: int, game_id: int,
+                           current_user: Annotated[Principal, Depends(get_current_user)],
+                           session : SessionDep,
+                           period: Period = Query(Period.all)) -> SingleRankWithScore:
     # ensure current user is asking about their own resource
     if current_user.id != user_id:
         raise HTTPException(status_code=401, detail=f'you do not have permission to view this resource. {current_user.id}')
     
-    # retrieve rank and score from redis
+    # retrieve rank and score from redis, or postgres while it is down
     try:
-        rank, score = retrieve_ranking(user_id, game_id)
-        if rank is None or score is None:
-            raise HTTPException(status_code=400, detail="Could not find the rank of the user for this game.")
-    except ConnectionError:
-        raise HTTPException(status_code=503, detail="Redis connection failed.")
+        rank, score = await read_with_fallback(lambda: retrieve_ranking(user_id, game_id, period),
+                                               lambda: pg_retrieve_ranking(session, user_id, game_id, period))
     except Exception as e:
         log_and_raise_error(f"Unexpected error occurred: {e}", 500)
     if rank == None or score == None:
         raise HTTPException(status_code=400, detail=f'Could not find the rank of the user for this game. Please check the provided details.')
     
     # get game name
-    game_name = read_db_value(get_game_cache, retry_set_game_cache, session, game_id, Game, 'name')
+    game_name = await read_db_value(get_game_cache, retry_set_game_cache, session, game_id, Game, 'name')
 
     return {"game" : game_name, "rank": rank, "score" : score}
 
@@ -353,20 +783,39 @@ def user_score_single_game(user_id: int, game_id,
 # user's rankings for all games
 # redis
 @router.get('/users/{user_id}/ranking', response_model = MultipleRanks)
-def users_rankings_all_game(user_id : int, 
-                            current_user: Annotated[User, Depends(get_current_user)],
+async def users_rankings_all_game(user_id : int, 
+                            request: Request,
+                            current_user: Annotated[Principal, Depends(get_current_user)],
                             session : SessionDep):
     # ensure current user is asking about their own resource
     check_user(current_user.id, user_id)
 
-    # retrieve data from redis
-    results = user_data_all_games(user_id)
+    # retrieve data from redis, only for the games this user has played. postgres while redis is down
+    results = await read_with_fallback(lambda: user_data_all_games(user_id),
+                                       lambda: pg_user_data_all_games(session, user_id))
 
-    # raise exception or return the data
+    # raise exception or return the data
     if results == None:
-        HTTPException(status_code=404, detail = "No ranking information found")
-    
-    return results
+        raise HTTPException(status_code=404, detail = "No ranking information found")
+
+    # game names in one lookup, falling back to postgres for any not cached
+    game_ids = [game_id for game_id, _, _ in results]
+    game_names = await read_with_fallback(lambda: get_multiple_game_names(game_ids), lambda: no_usernames(game_ids))
+    games = []
+    for (game_id, rank, score), game_name in zip(results, game_names):
+        if game_name is None:
+            game = await session.get(Game, int(game_id))
+            # a game that no longer exists (or never did) is left out rather than failing every other game
+            if game is None:
+                logger.warning(f'no game {game_id} for ranking of user {user_id}')
+                continue
+            game_name = game.name
+            if redis_available():
+                await retry_set_game_cache(game_name, int(game_id))
+        games.append({"game": game_name, "rank": rank, "score": score})
+
+    # already in the shape of MultipleRanks, which stays on the route for the docs
+    return fast_response(request, {"games": games})
 
 
 ## 1.9 info on the top 10 players for an individual game
@@ -374,20 +823,137 @@ def users_rankings_all_game(user_id : int,
 # games/{game_id}/leaders
 # GET
 # top players report for a single game
+# redis, pg on a profile cache miss
+@router.get('/games/{game_id}/leaders', response_model= TopPlayerList)
+async def top_players(game_id : int,
+                current_user: Annotated[Principal, Depends(get_current_user)],
+                session : SessionDep,
+                period: Period = Query(Period.all)):
+
+    # served from the report cache while it lasts
+    body = await read_with_fallback(lambda: get_cached_report(game_id, period), no_version)
+    if body is not None:
+        return Response(content=body, media_type="application/json")
+
+    # get top 10 players for the game from redis, periodic boards are kept up to date on submit. postgres while it is down
+    async def pg_leaders():
+        return [user_id for user_id, _ in await pg_retrieve_leaders(session, game_id, 0, 9, period)]
+    leaders = await read_with_fallback(lambda: retrieve_leaders_no_score(game_id, 0, 9, period), pg_leaders)
+
+    # player profiles from the cache, postgres for any missing
+    player_data = await get_player_info(leaders, session)
+
+    if player_data is None:
+        raise HTTPException(status_code=404, detail = 'Failed to find top player report data')
+
+    body = TopPlayerList(leaders=player_data).model_dump_json()
+    if redis_available():
+        try:
+            await set_cached_report(game_id, period, body)
+        except RedisError as e:
+            logger.error(f'Failed to cache the report for game {game_id}: {e}')
+
+    return Response(content=body, media_type="application/json")
+
+
+## 1.10 deactivate a user ##
+
+# users/{user_id}/deactivate
+# POST
+# admin route, the cached principal is dropped everywhere so the user is locked out on their next request
 # pg
-@router.get('games/{game_id}/leaders', response_model= TopPlayerList)
-def top_players(game_id : int,
-                current_user: Annotated[User, Depends(get_current_user)],
-                session : SessionDep):
-    
-    # get top 10 players for the game from redis
-    leaders = retrieve_leaders(game_id, 0, 9)
+@router.post('/users/{user_id}/deactivate', response_model=UserPublic)
+async def deactivate_user(user_id: int,
+                          current_user: Annotated[Principal, Depends(get_current_user)],
+                          session: SessionDep):
+    if current_user.is_admin != True:
+        raise HTTPException(status_code=401, detail='Only admin can deactivate users')
 
-    # retrieve player information from postgres
-    player_data = get_player_info(leaders, session)
+    user = await session.get(User, user_id)
+    if user is None:
+        raise HTTPException(status_code=404, detail='User not found')
+
+    user.is_active = False
+    session.add(user)
+    await session.commit()
+
+    await invalidate_principal(user.email)
+
+    return user
 
-    if player_data is None:
-        return HTTPException(status_code=404, detail = 'Failed to find top player report data')
-    
-    return player_data
 
+## 1.11 connection pool stats ##
+
+# health/pools
+# GET
+# checked-out, waiting and timeout counts for the redis and postgres pools, for sizing them
+@router.get('/health/pools')
+async def connection_pool_stats():
+    return pool_stats()
+
+
+## 1.12 prometheus metrics ##
+
+# metrics
+# GET
+# route latency, redis and postgres timings, cache hit ratios, retries and pool usage
+@router.get('/metrics', include_in_schema=False)
+async def metrics():
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+
+## 1.13 live leaderboard ##
+
+# games/leaderboard/{game_id}/ws
+# WEBSOCKET
+# pushes a snapshot of the top N on connect, then a diff at most once per tick while the board changes
+# redis, through the game's shared broadcaster
+@router.websocket('/games/leaderboard/{game_id}/ws')
+async def leaderboard_websocket(websocket: WebSocket, game_id: int, period: Period = Period.all):
+    await websocket.accept()
+    broadcaster, queue = subscribe(game_id, period)
+
+    async def send_updates():
+        while True:
+            await websocket.send_text(await queue.get())
+
+    # viewers never send anything, but reading is how a disconnect is noticed on a quiet board
+    async def wait_for_disconnect():
+        try:
+            while True:
+                await websocket.receive_text()
+        except WebSocketDisconnect:
+            pass
+
+    tasks = [asyncio.create_task(send_updates()), asyncio.create_task(wait_for_disconnect())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        unsubscribe(broadcaster, queue)
+
+
+# games/leaderboard/{game_id}/stream
+# GET
+# the same updates as server-sent events, for clients that cannot hold a websocket
+@router.get('/games/leaderboard/{game_id}/stream')
+async def leaderboard_event_stream(game_id: int, period: Period = Query(Period.all)):
+    broadcaster, queue = subscribe(game_id, period)
+
+    async def events():
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), BROADCAST_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    # keeps proxies from closing an idle stream
+                    yield ': keepalive\n\n'
+                    continue
+                yield f'data: {message}\n\n'
+        finally:
+            unsubscribe(broadcaster, queue)
+
+    return StreamingResponse(events(), media_type='text/event-stream',
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
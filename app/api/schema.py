@@ -1,4 +1,4 @@
-from pydantic import BaseModel 
+from pydantic import BaseModel, Field
 from enum import Enum
 from datetime import datetime
 from typing import List 
@@ -22,6 +22,11 @@ class UserPublic(BaseModel):
     is_active: bool | None = None
     country : str
 
+# profile fields a user can change, anything left out is kept
+class UserUpdate(BaseModel):
+    username : str | None = None
+    country : str | None = None
+
 # user for internall (full)
 class UserPrivate(UserPublic):
     hashed_password: str
@@ -44,21 +49,64 @@ class TokenData(BaseModel):
     email: str | None = None
 
 
+# the authenticated caller, all the routes need to know about them
+class Principal(BaseModel):
+    id: int
+    email: str
+    is_admin: bool | None = None
+
+
 ### 3. Score ###
 
 class ScoreInput(BaseModel):
     score : float
     game_id : int
 
+# id is only known once the score is in postgres, in write-behind mode the stream id is returned instead.
+# rank, leaderboard_score and previous_best are the all-time board after this submission
 class ScorePublic(BaseModel):
-    id : int
+    id : int | None = None
     user_id : int
     score : float
     game_id : int
     date_added : datetime
+    stream_id : str | None = None
+    rank : int | None = None
+    leaderboard_score : float | None = None
+    previous_best : float | None = None
+
+# batch submission from game servers
+MAX_SCORE_BATCH = 1000
+
+class ScoreBatchItem(ScoreInput):
+    user_id : int
+
+class ScoreBatchInput(BaseModel):
+    scores : List[ScoreBatchItem] = Field(min_length=1, max_length=MAX_SCORE_BATCH)
+
+# status is per row: 200, or 404 with the reason in error for a row that was not stored
+class ScoreBatchResult(ScorePublic):
+    leaderboard_updated : bool
+    status : int = 200
+    error : str | None = None
+
+class ScoreBatchPublic(BaseModel):
+    results : List[ScoreBatchResult]
 
 ### 4. Rank ###
 
+# leaderboard export formats
+class ExportFormat(str, Enum):
+    ndjson = 'ndjson'
+    csv = 'csv'
+
+# leaderboard period, 'all' is the all-time board
+class Period(str, Enum):
+    all = 'all'
+    day = 'day'
+    week = 'week'
+    month = 'month'
+
 class SingleRank(BaseModel):
     game: str
     rank : int
@@ -67,13 +115,40 @@ class SingleRankWithScore(SingleRank):
     score : float 
 
 class MultipleRanks(BaseModel):
-    games : List[SingleRank]
+    games : List[SingleRankWithScore]
+
+# min is None for the lowest bucket and max None for the highest
+class HistogramBucket(BaseModel):
+    min : float | None
+    max : float | None
+    count : int
+
+class ScoreDistribution(BaseModel):
+    game : str
+    total : int
+    buckets : List[HistogramBucket]
+
+# percentile is the share of players scoring below, top_percent the share at or above the score
+class ScorePercentile(BaseModel):
+    game : str
+    score : float
+    approximate_rank : int | None
+    total : int
+    percentile : float | None
+    top_percent : float | None
 
 
 ### 5. Game ids 
 
+# how a new score combines with the user's stored one
+class ScoreMode(str, Enum):
+    max = 'max'              # keep the highest
+    min = 'min'              # keep the lowest
+    overwrite = 'overwrite'  # keep the latest
+
 class GameIDInput(BaseModel):
     name : str
+    score_mode : ScoreMode = ScoreMode.max
 
 class GameID(GameIDInput):
     id: int
@@ -85,6 +160,7 @@ class GameLookUp(BaseModel):
 ### 6. Player profile
 
 class TopPlayerInfo(BaseModel):
+    rank : int
     username : str
     country : str
     date_joined : datetime
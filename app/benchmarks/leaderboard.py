@@ -0,0 +1,439 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+
+# load and micro benchmarks for the leaderboard service, run offline against local stand-ins.
+# run with: python -m benchmarks.leaderboard [--members 100000] [--output results.json]
+#
+# redis defaults to fakeredis and postgres to a throwaway sqlite file, pass --redis-url / --database-url
+# to point at a local redis-server or postgres instead (both are wiped, so --flush is required for them).
+# needs the packages in requirements-bench.txt (repo root)
+
+
+### 0. Initialization ###
+
+
+## 0.1 logger ##
+
+logger = logging.getLogger('benchmarks')
+
+
+## 0.2 scenarios ##
+
+# name -> what is measured. api scenarios go through the fastapi app in-process (routing, auth, serialisation),
+# data scenarios call the data layer directly
+SCENARIOS = {
+    'submit': 'submit one score and get the new rank back',
+    'top_n': 'top N of a game leaderboard',
+    'rank': "one user's rank in one game",
+    'all_games': "one user's rank in every game they play",
+    'report': 'top players report for a game',
+}
+LEVELS = ('api', 'data')
+# page sizes for the response serialisation comparison
+SERIALISATION_ROWS = (10, 100, 1000)
+
+SEED_CHUNK_SIZE = 10000
+COUNTRIES = ['uk', 'us', 'de', 'fr', 'jp', 'br', 'in', 'au']
+
+
+### 1. STAND-INS ###
+
+## 1.1 environment ##
+
+# must run before any app module is imported, the connection settings are read at import
+def configure_environment(args):
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ['DATABASE_URL'] = args.database_url
+    if args.redis_url:
+        os.environ['REDIS_URI'] = args.redis_url
+    else:
+        use_fakeredis()
+
+
+# every client the app creates is backed by in-memory fakeredis servers, through the same instrumented pools
+def use_fakeredis():
+    import fakeredis
+    from fakeredis.aioredis import FakeConnection
+    from data import connections
+    from data.metrics import InstrumentedRedis
+
+    # one server per node, so sharded games are spread the same way they would be
+    servers = {}
+
+    def make_fake_client(db: int, uri: str = connections.REDIS_URI):
+        if (uri, db) not in connections.redis_pools:
+            server = servers.setdefault(uri, fakeredis.FakeServer())
+            connections.redis_pools[(uri, db)] = connections.InstrumentedRedisPool(
+                connection_class=FakeConnection, server=server, db=db, decode_responses=True,
+                max_connections=connections.REDIS_MAX_CONNECTIONS, timeout=connections.REDIS_POOL_TIMEOUT)
+        return InstrumentedRedis(connection_pool=connections.redis_pools[(uri, db)])
+
+    connections.make_client = make_fake_client
+
+
+## 1.2 reset ##
+
+async def reset_stores(args):
+    from sqlmodel import SQLModel
+    from api.database import engine
+    from data.leaderboard import r_leaderboard, r_user, r_game
+
+    clients = {id(client.connection_pool): client for client in (r_leaderboard, r_user, r_game)}.values()
+    external = args.redis_url or not args.database_url.startswith('sqlite')
+    if external and not args.flush:
+        for client in clients:
+            if await client.dbsize():
+                raise SystemExit('redis is not empty, pass --flush to wipe it before seeding')
+    for client in clients:
+        await client.flushdb()
+
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.drop_all)
+        await conn.run_sync(SQLModel.metadata.create_all)
+
+
+### 2. SYNTHETIC DATA ###
+
+# users 1..members each hold one score in every game, so every sorted set has `members` entries.
+# the same seed always gives the same data
+async def seed(args, rng: random.Random):
+    from sqlalchemy import insert
+    from api.database import async_session
+    from api.models import User, Game
+    from data.leaderboard import r_leaderboard, r_user, r_game, leaderboard_key, user_games_key, name_bucket_key
+    from data.leaderboard import GAME_MODES_KEY, USER_NAME_PREFIX, GAME_NAME_PREFIX
+    from data.leaderboard import DEFAULT_HISTOGRAM_EDGES, histogram_key, histogram_bucket
+
+    started = time.perf_counter()
+    game_ids = list(range(1, args.games + 1))
+    now = datetime.utcnow()
+
+    async with async_session() as session:
+        await session.execute(insert(Game), [{"id": game_id, "name": f'game{game_id}', "score_mode": 'max', "date_added": now}
+                                             for game_id in game_ids])
+        for first in range(1, args.members + 1, SEED_CHUNK_SIZE):
+            ids = range(first, min(first + SEED_CHUNK_SIZE, args.members + 1))
+            await session.execute(insert(User), [{"id": user_id, "username": f'player{user_id}', "email": f'player{user_id}@bench',
+                                                  "hashed_password": 'x', "country": rng.choice(COUNTRIES),
+                                                  "is_active": True, "is_admin": False, "date_added": now}
+                                                 for user_id in ids])
+        await session.commit()
+
+    pipeline = r_game.pipeline(transaction=False)
+    for game_id in game_ids:
+        pipeline.hset(name_bucket_key(GAME_NAME_PREFIX, game_id), game_id, f'game{game_id}')
+    await pipeline.execute()
+    await r_leaderboard.hset(GAME_MODES_KEY, mapping={game_id: 'max' for game_id in game_ids})
+
+    for first in range(1, args.members + 1, SEED_CHUNK_SIZE):
+        ids = range(first, min(first + SEED_CHUNK_SIZE, args.members + 1))
+        pipeline = r_leaderboard.pipeline(transaction=False)
+        for game_id in game_ids:
+            scores = {user_id: rng.randint(0, args.members * 10) for user_id in ids}
+            pipeline.zadd(leaderboard_key(game_id), scores)
+            # the submit script moves members between histogram buckets, so seed the counts it expects
+            buckets = {}
+            for score in scores.values():
+                bucket = histogram_bucket(DEFAULT_HISTOGRAM_EDGES, score)
+                buckets[bucket] = buckets.get(bucket, 0) + 1
+            for bucket, count in buckets.items():
+                pipeline.hincrby(histogram_key(game_id), bucket, count)
+        for user_id in ids:
+            pipeline.sadd(user_games_key(user_id), *game_ids)
+        await pipeline.execute()
+
+        pipeline = r_user.pipeline(transaction=False)
+        for user_id in ids:
+            pipeline.hset(name_bucket_key(USER_NAME_PREFIX, user_id), user_id, f'player{user_id}')
+        await pipeline.execute()
+
+    logger.info(f'Seeded {args.games} games x {args.members} members in {time.perf_counter() - started:.1f}s')
+    return game_ids
+
+
+### 3. OPERATIONS ###
+
+# each factory returns an async callable doing one operation, raising if it failed
+
+## 3.1 api level ##
+
+def api_operations(client, rng: random.Random, args, game_ids):
+    from api.auth import create_access_token
+
+    # tokens are minted directly, logging in would benchmark bcrypt instead
+    tokens = {}
+    def headers(user_id):
+        if user_id not in tokens:
+            tokens[user_id] = {"Authorization": "Bearer " + create_access_token({"sub": f'player{user_id}@bench', "uid": user_id, "adm": False})}
+        return tokens[user_id]
+
+    def pick_user():
+        return rng.randint(1, args.members)
+
+    async def request(method, url, **kwargs):
+        response = await client.request(method, url, **kwargs)
+        if response.status_code >= 400:
+            raise RuntimeError(f'{method} {url} -> {response.status_code}')
+
+    async def submit():
+        user_id = pick_user()
+        await request('POST', f'/users/{user_id}/scores', headers=headers(user_id),
+                      json={"game_id": rng.choice(game_ids), "score": rng.randint(0, args.members * 10)})
+
+    async def top_n():
+        await request('GET', f'/games/leaderboard/{rng.choice(game_ids)}', params={"start": 0, "end": args.top - 1})
+
+    async def rank():
+        user_id = pick_user()
+        await request('GET', f'/users/{user_id}/ranking/{rng.choice(game_ids)}', headers=headers(user_id))
+
+    async def all_games():
+        user_id = pick_user()
+        await request('GET', f'/users/{user_id}/ranking', headers=headers(user_id))
+
+    async def report():
+        await request('GET', f'/games/{rng.choice(game_ids)}/leaders', headers=headers(pick_user()))
+
+    return {'submit': submit, 'top_n': top_n, 'rank': rank, 'all_games': all_games, 'report': report}
+
+
+## 3.2 data level ##
+
+def data_operations(rng: random.Random, args, game_ids):
+    from api.database import async_session
+    from api.schema import ScoreInput
+    from data.leaderboard import retry_submit_score, retrieve_leaders, retrieve_ranking, user_data_all_games, retrieve_leaders_no_score
+    from data.postgres import get_player_info
+
+    async def submit():
+        score = ScoreInput(game_id=rng.choice(game_ids), score=rng.randint(0, args.members * 10))
+        await retry_submit_score(score, rng.randint(1, args.members))
+
+    async def top_n():
+        await retrieve_leaders(rng.choice(game_ids), 0, args.top - 1)
+
+    async def rank():
+        await retrieve_ranking(rng.randint(1, args.members), rng.choice(game_ids))
+
+    async def all_games():
+        await user_data_all_games(rng.randint(1, args.members))
+
+    async def report():
+        leaders = await retrieve_leaders_no_score(rng.choice(game_ids), 0, 9)
+        async with async_session() as session:
+            result = await get_player_info(leaders, session)
+        if result is None:
+            raise RuntimeError('no report data')
+
+    return {'submit': submit, 'top_n': top_n, 'rank': rank, 'all_games': all_games, 'report': report}
+
+
+### 4. RUNNER ###
+
+def percentile(sorted_values, fraction: float):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+# `requests` operations spread over `concurrency` tasks, after `warmup` untimed ones
+async def run_scenario(operation, requests: int, concurrency: int, warmup: int):
+    for _ in range(warmup):
+        try:
+            await operation()
+        except Exception:
+            pass
+
+    latencies = []
+    errors = {}
+    remaining = iter(range(requests))
+
+    async def worker():
+        for _ in remaining:
+            started = time.perf_counter()
+            try:
+                await operation()
+                latencies.append(time.perf_counter() - started)
+            except Exception as e:
+                message = str(e)[:200]
+                errors[message] = errors.get(message, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {"ops": len(latencies),
+            "errors": sum(errors.values()),
+            "error_samples": dict(sorted(errors.items(), key=lambda item: -item[1])[:3]),
+            "seconds": round(elapsed, 3),
+            "throughput": round(len(latencies) / elapsed, 1) if elapsed else None,
+            "mean_ms": ms(sum(latencies) / len(latencies)) if latencies else None,
+            "p50_ms": ms(percentile(latencies, 0.50)),
+            "p95_ms": ms(percentile(latencies, 0.95)),
+            "p99_ms": ms(percentile(latencies, 0.99)),
+            "max_ms": ms(latencies[-1] if latencies else None)}
+
+
+## 4.1 serialisation ##
+
+# cpu time to turn one leaderboard page into a body. 'default' is what fastapi does with a returned dict
+# (jsonable_encoder, then json.dumps in JSONResponse), against the orjson and msgpack encoders in api/responses.py
+def serialisation_benchmark(rng: random.Random, rows_list, total_rows: int = 50000):
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+    from api.responses import encode, JSON_MEDIA_TYPE, MSGPACK_MEDIA_TYPE
+
+    encoders = {
+        'default': lambda page: JSONResponse(jsonable_encoder(page)).body,
+        'orjson': lambda page: encode(page, JSON_MEDIA_TYPE),
+        'msgpack': lambda page: encode(page, MSGPACK_MEDIA_TYPE),
+    }
+    results = {}
+    for rows in rows_list:
+        page = {"game": "benchmark", "data": [{"rank": i + 1, "username": f'player{rng.randint(1, 10 ** 7)}',
+                                               "score": float(rng.randint(0, 10 ** 7))} for i in range(rows)]}
+        iterations = max(10, total_rows // rows)
+        for name, encoder in encoders.items():
+            started = time.process_time()
+            for _ in range(iterations):
+                encoder(page)
+            results[f'{name}.{rows}'] = {"rows": rows, "iterations": iterations,
+                                         "cpu_us": round((time.process_time() - started) / iterations * 1e6, 2),
+                                         "bytes": len(encoder(page))}
+        default = results[f'default.{rows}']['cpu_us']
+        for name in encoders:
+            result = results[f'{name}.{rows}']
+            result["saved_percent"] = round((default - result["cpu_us"]) / default * 100, 1) if default else None
+        logger.info(f'serialisation {rows} rows: default {default}us, ' + ', '.join(
+            f'{name} {results[f"{name}.{rows}"]["cpu_us"]}us ({results[f"{name}.{rows}"]["saved_percent"]}% saved)'
+            for name in encoders if name != 'default'))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__), timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+async def run(args):
+    configure_environment(args)
+    import httpx
+    from api.main import app
+
+    rng = random.Random(args.seed)
+    await reset_stores(args)
+    game_ids = await seed(args, rng)
+
+    results = {}
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://bench') as client:
+        for level in args.levels:
+            operations = api_operations(client, rng, args, game_ids) if level == 'api' else data_operations(rng, args, game_ids)
+            for name in args.scenarios:
+                result = await run_scenario(operations[name], args.requests, args.concurrency, args.warmup)
+                results[f'{level}.{name}'] = result
+                logger.info(f'{level}.{name}: {result["throughput"]} ops/s p50 {result["p50_ms"]}ms '
+                            f'p95 {result["p95_ms"]}ms p99 {result["p99_ms"]}ms errors {result["errors"]}')
+
+    serialisation = serialisation_benchmark(rng, args.serialisation_rows) if args.serialisation_rows else {}
+
+    from data.connections import pool_stats
+    from api.database import engine
+    pools = pool_stats()
+    # aiosqlite keeps a thread per connection that would hold the interpreter open
+    await engine.dispose()
+    return {"meta": {"commit": git_commit(),
+                     "timestamp": datetime.utcnow().isoformat(),
+                     "python": platform.python_version(),
+                     "redis": args.redis_url or 'fakeredis',
+                     "database": args.database_url.split('@')[-1],
+                     "members": args.members, "games": args.games, "requests": args.requests,
+                     "concurrency": args.concurrency, "top": args.top, "seed": args.seed},
+            "results": results,
+            "serialisation": serialisation,
+            "pools": pools}
+
+
+### 5. COMPARISON ###
+
+# throughput and p95 change against an earlier run, positive throughput / negative p95 is better
+def compare(current: dict, baseline: dict):
+    lines = [f'{"scenario":<18}{"ops/s":>12}{"change":>9}{"p95 ms":>12}{"change":>9}']
+    for name, result in current['results'].items():
+        before = baseline.get('results', {}).get(name)
+        change = lambda new, old: f'{(new - old) / old * 100:+.1f}%' if new is not None and old else 'n/a'
+        lines.append(f'{name:<18}{result["throughput"] or 0:>12}'
+                     f'{change(result["throughput"], before and before["throughput"]):>9}'
+                     f'{result["p95_ms"] or 0:>12}{change(result["p95_ms"], before and before["p95_ms"]):>9}')
+    return '\n'.join(lines)
+
+
+### 6. COMMAND LINE ###
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.leaderboard')
+    parser.add_argument('--members', type=int, default=10000, help='members per game sorted set (10k - 10M)')
+    parser.add_argument('--games', type=int, default=3)
+    parser.add_argument('--requests', type=int, default=2000, help='timed operations per scenario')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--top', type=int, default=10, help='N for the top-N scenario')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--scenario', action='append', dest='scenarios', choices=list(SCENARIOS), help='repeatable (default all)')
+    parser.add_argument('--level', action='append', dest='levels', choices=LEVELS, help='repeatable (default both)')
+    parser.add_argument('--redis-url', help='local redis-server to use instead of fakeredis')
+    parser.add_argument('--database-url', help='local postgres to use instead of a temporary sqlite file')
+    parser.add_argument('--flush', action='store_true', help='allow wiping a non-empty --redis-url / --database-url')
+    parser.add_argument('--output', help='write the results as json to this file')
+    parser.add_argument('--compare', help='json from an earlier run to compare against')
+    parser.add_argument('--verbose', action='store_true', help='keep the service logs')
+    parser.add_argument('--serialisation-rows', type=lambda value: [int(rows) for rows in value.split(',') if rows],
+                        default=list(SERIALISATION_ROWS), help='comma separated page sizes for the serialisation comparison, empty to skip')
+    args = parser.parse_args()
+
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    args.levels = args.levels or list(LEVELS)
+    if args.database_url is None:
+        path = os.path.join(tempfile.gettempdir(), 'leaderboard_benchmark.db')
+        if os.path.exists(path):
+            os.remove(path)
+        args.database_url = f'sqlite+aiosqlite:///{path}'
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    if args.verbose:
+        results = asyncio.run(run(args))
+    else:
+        # the service logs every request, which would swamp the timings
+        for name in ('api', 'data', 'httpx'):
+            logging.getLogger(name).setLevel(logging.CRITICAL)
+        results = asyncio.run(run(args))
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+        logger.info(f'Results written to {args.output}')
+    else:
+        print(report)
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(results, json.load(f)))
+
+
+if __name__ == '__main__':
+    main()
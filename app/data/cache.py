@@ -0,0 +1,55 @@
+import time
+from collections import OrderedDict
+
+
+### 1. IN-PROCESS CACHE ###
+
+# every cache created in this process, read by the metrics endpoint
+CACHES = []
+
+# bounded LRU with a TTL per entry, in front of the redis name caches.
+# values that are None are never stored, a miss always means "ask redis".
+class LocalCache:
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        CACHES.append(self)
+
+    def get(self, key):
+        key = str(key)
+        entry = self._entries.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, value, ttl: float | None = None):
+        if value is None:
+            return
+        key = str(key)
+        self._entries[key] = (value, time.monotonic() + (ttl if ttl is not None else self.ttl))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(str(key), None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"name": self.name, "size": len(self._entries), "hits": self.hits, "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0}
@@ -1,7 +1,17 @@
-import redis
-from api.schema import ScorePublic
+from redis.exceptions import RedisError
+from api.schema import ScorePublic, Period
+from data.cache import LocalCache
+from data.metrics import redis_timed, REDIS_RETRIES, REDIS_RETRIES_EXHAUSTED, REDIS_RETRIES_DROPPED, NAME_CACHE_LOOKUPS
+from data.connections import make_client, circuit_breaker, REDIS_LEADERBOARD_DB, REDIS_USER_DB, REDIS_GAME_DB, REDIS_SHARD_URIS
+from decouple import config
+from uuid import uuid4
+from datetime import datetime, timedelta
+from bisect import bisect_right
 import logging
-import time
+import asyncio
+import heapq
+import json
+import zlib
 
 
 ### 0. Initialization ###
@@ -9,42 +19,89 @@ import time
 
 ## 0.1 logger ##
 
-logging.basicConfig(level=logging.INFO,
-                    format="%(asctime)s - %(levelname)s - %(message)s",
-                    handlers=[
-        logging.StreamHandler(),  # Logs to console
-        logging.FileHandler("leaderboard.log")  # Logs to file
-    ])
-
 logger = logging.getLogger(__name__)
 
 
 ## 0.2 redis setup ##
 
+# asyncio clients so a request awaiting redis does not hold a threadpool worker.
+# pools are shared and sized in data/connections.py, clients on the same db share one pool
+
 # redis setup for all time leaderboard
-r_leaderboard = redis.StrictRedis(host='redis', port=6379, db=0, decode_responses=True)
+r_leaderboard = make_client(REDIS_LEADERBOARD_DB)
 
 # redis cache for user (id -> username)
-r_user = redis.StrictRedis(host='redis', port=6379, db=1, decode_responses=True)
+r_user = make_client(REDIS_USER_DB)
 
 # redis cache for game (id -> name)
-r_game = redis.StrictRedis(host='redis', port=6379, db=2, decode_responses=True)
+r_game = make_client(REDIS_GAME_DB)
+
+# leaderboard db on each shard node, empty unless REDIS_SHARD_URIS is set
+shard_clients = [make_client(REDIS_LEADERBOARD_DB, uri) for uri in REDIS_SHARD_URIS]
 
 
 ## 0.3 retry base function ##
 
-# generic function to retry an operation -> this will retry if there is a redis set failure
-def retry_cache_operation(operation, *args, retries=3, delay=0.5):
-    for attempt in range(retries):
-        try:
-            operation(*args)
-            return
-        except redis.RedisError as e:
-            logger.error(f"Redis error (attempt {attempt + 1}/{retries}): {str(e)}")
-            if attempt < retries - 1:
-                time.sleep(delay * (2 ** attempt))
-            else:
-                raise e
+# a failed write is not retried inside the request. it goes on a bounded in-process queue that drain_retry_queue
+# works through in the background, in order, so a degraded redis costs a request one failed call at most (none while
+# the circuit is open, see data/connections.py). when the queue is full the write is dropped and counted
+REDIS_RETRY_QUEUE_SIZE = config('REDIS_RETRY_QUEUE_SIZE', default=1000, cast=int)
+REDIS_RETRY_ATTEMPTS = config('REDIS_RETRY_ATTEMPTS', default=5, cast=int)
+# seconds to back off after a failed background attempt, doubled after each further failure
+REDIS_RETRY_DELAY = config('REDIS_RETRY_DELAY', default=0.5, cast=float)
+
+retry_queue: asyncio.Queue = asyncio.Queue(maxsize=REDIS_RETRY_QUEUE_SIZE)
+
+def queue_retry(operation, *args):
+    try:
+        retry_queue.put_nowait((operation, args))
+    except asyncio.QueueFull:
+        REDIS_RETRIES_DROPPED.labels(operation.__name__).inc()
+        logger.error(f"Retry queue full, dropping {operation.__name__}")
+
+
+# generic function for redis writes on the request path -> one attempt, queued for retry on failure.
+# returns None if it failed, callers must be fine without the result
+async def retry_cache_operation(operation, *args):
+    try:
+        return await operation(*args)
+    except RedisError as e:
+        logger.error(f"Redis error in {operation.__name__}, queued for retry: {str(e)}")
+        queue_retry(operation, *args)
+        return None
+
+
+# runs for the lifetime of the app (started in api/main.py)
+async def drain_retry_queue():
+    while True:
+        operation, args = await retry_queue.get()
+        for attempt in range(REDIS_RETRY_ATTEMPTS):
+            # straight away while the circuit is closed, so a backlog drains as fast as redis takes it. the backoff
+            # only follows a failed attempt, and waiting out an open circuit does not use up attempts
+            delay = circuit_breaker().retry_after()
+            if attempt > 0:
+                delay = max(REDIS_RETRY_DELAY * (2 ** (attempt - 1)), delay)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await operation(*args)
+                break
+            except RedisError as e:
+                logger.error(f"Redis error retrying {operation.__name__} (attempt {attempt + 1}/{REDIS_RETRY_ATTEMPTS}): {str(e)}")
+                REDIS_RETRIES.labels(operation.__name__).inc()
+            except Exception as e:
+                logger.error(f"Unexpected error retrying {operation.__name__}, dropping it: {e}")
+                break
+        else:
+            REDIS_RETRIES_EXHAUSTED.labels(operation.__name__).inc()
+
+
+## 0.4 redis outage ##
+
+# leaderboard reads go straight to the postgres fallback (data/postgres.py) while the main node's circuit is open,
+# instead of each request waiting out the socket timeout again
+def redis_available() -> bool:
+    return circuit_breaker().available()
 
 
 ### 2. SORTED SET for leaderboard ###
@@ -53,121 +110,941 @@ def retry_cache_operation(operation, *args, retries=3, delay=0.5):
 # submits a single score with score.game the name of the set, score.user_id the member and score.score as the score
 
 
+## 2.0 leaderboard keys ##
+
+# the all-time board is keyed by the game id, periodic boards by game:period:bucket (e.g. 3:day:20241120).
+# each period maps to the strftime format of its bucket and how long a bucket is kept once created
+PERIODS = {
+    Period.day: ('%Y%m%d', timedelta(days=3)),
+    Period.week: ('%G%V', timedelta(weeks=3)),
+    Period.month: ('%Y%m', timedelta(days=93)),
+}
+
+def leaderboard_key(game_id, period: Period | None = None, when: datetime | None = None):
+    if period is None or period == Period.all:
+        return game_id
+    bucket_format, _ = PERIODS[period]
+    return f'{game_id}:{period.value}:{(when or datetime.utcnow()).strftime(bucket_format)}'
+
+# start of the bucket that `when` falls in
+def period_start(period: Period, when: datetime | None = None):
+    day = (when or datetime.utcnow()).replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == Period.week:
+        return day - timedelta(days=day.weekday())
+    if period == Period.month:
+        return day.replace(day=1)
+    return day
+
+# set of the game ids a user has a score in, so their rankings never need a keyspace scan
+def user_games_key(user_id):
+    return f'user:{user_id}:games'
+
+# counter bumped on every write to any of a game's boards, cached pages are keyed on it
+def version_key(game_id):
+    return f'version:{game_id}'
+
+# per-game ScoreMode ('max', 'min' or 'overwrite'), read by the submit script. set when a game is created.
+# min games keep their scores negated on the boards, so every board reads highest first and the lowest real
+# score ranks first. the reads below turn them back with board_score
+GAME_MODES_KEY = 'game:modes'
+DEFAULT_SCORE_MODE = 'max'
+
+# the game id is published here whenever a write changes one of its boards, live viewers follow it (see api/broadcast.py)
+LEADERBOARD_CHANGES_CHANNEL = 'leaderboard:changes'
+
+# count of all-time board members per score bucket, hash of bucket index -> count, kept in step by the submit script
+def histogram_key(game_id):
+    return f'histogram:{game_id}'
+
+# bucket edges each game's histogram was started with (comma separated, ascending). pinned on the game's first
+# write so changing SCORE_HISTOGRAM_EDGES only affects new games, rebuild a game to move it onto new edges
+HISTOGRAM_EDGES_KEY = 'game:histogram_edges'
+SCORE_HISTOGRAM_EDGES = config('SCORE_HISTOGRAM_EDGES', default='0,10,25,50,100,250,500,1000,2500,5000,10000,25000,50000,100000')
+DEFAULT_HISTOGRAM_EDGES = [float(edge) for edge in SCORE_HISTOGRAM_EDGES.split(',')]
+
+# bucket 0 holds scores below the first edge, bucket i scores in [edges[i-1], edges[i]), the last one everything above
+def histogram_bucket(edges: list[float], score: float) -> int:
+    return bisect_right(edges, score)
+
+
+## 2.0.1 sharded games ##
+
+# games listed here have their boards (and histogram) hash-partitioned by user id across the REDIS_SHARD_URIS nodes,
+# each shard holding its users' members under the usual keys. everything else about the game stays on the main node.
+# the functions below route on this, callers do not need to know. moving a game in or out of the list needs a rebuild
+SHARDED_GAMES = {int(game_id) for game_id in config('SHARDED_GAMES', default='').split(',') if game_id.strip()}
+
+def is_sharded(game_id) -> bool:
+    return bool(shard_clients) and int(game_id) in SHARDED_GAMES
+
+# crc32 rather than hash() so every process agrees on the shard
+def shard_index(user_id) -> int:
+    return zlib.crc32(str(user_id).encode()) % len(shard_clients)
+
+def shard_for(user_id):
+    return shard_clients[shard_index(user_id)]
+
+# every client holding part of the game's boards, and which of them holds the user's member
+def board_clients(game_id):
+    return shard_clients if is_sharded(game_id) else [r_leaderboard]
+
+def board_index(game_id, user_id) -> int:
+    return shard_index(user_id) if is_sharded(game_id) else 0
+
+# k-way merge of per-shard (member, score) lists that are each in board order (score descending, ties by member descending)
+def merge_shards(pages):
+    return list(heapq.merge(*pages, key=lambda entry: (entry[1], entry[0]), reverse=True))
+
+# ranks everywhere are positions in board order, as ZREVRANK gives them: tied players are numbered by member.
+# ahead() counts the members of one board that sort before (score, member), in O(log n) however many players tie.
+# if the member is on the board with that score it is its ZREVRANK. otherwise the member is put at (score, member)
+# for the moment it takes to read its ZREVRANK, then removed or put back where it was. nothing else runs in between.
+# the second value says whether the member itself was found
+BOARD_POSITION_LUA = """
+local function ahead(key, score, member)
+    local current = redis.call('ZSCORE', key, member)
+    if current and tonumber(current) == tonumber(score) then
+        return redis.call('ZREVRANK', key, member), true
+    end
+    redis.call('ZADD', key, score, member)
+    local count = redis.call('ZREVRANK', key, member)
+    if current then
+        redis.call('ZADD', key, current, member)
+    else
+        redis.call('ZREM', key, member)
+    end
+    return count, false
+end
+"""
+
+# KEYS: board   ARGV: score, member
+# returns the number of members ahead of (score, member)
+POSITION_SCRIPT = r_leaderboard.register_script(BOARD_POSITION_LUA + """
+return (ahead(KEYS[1], ARGV[1], ARGV[2]))
+""")
+
+# ordinal rank of a member on a sharded board: 1 + the members ahead of it on every shard, the same number
+# ZREVRANK would give on a single board
+async def sharded_rank(key, score, member) -> int:
+    args = [repr(float(score)), member]
+    return 1 + sum(await asyncio.gather(*(POSITION_SCRIPT(keys=[key], args=args, client=client) for client in shard_clients)))
+
+
 ## 2.1 submit a score ##
 
+# shared by the submit scripts: applies the game's mode with a conditional ZADD on the all-time board (boards[1]) and
+# the current periodic boards, sets the expiry on new period keys and, when the all-time score moves, moves its
+# histogram bucket count with it (old bucket -1, new bucket +1). histograms count real scores, not board scores.
+# returns the number of boards changed, the previous and the current all-time board score and the mode
+UPDATE_BOARDS_LUA = """
+local function update_boards(boards, ttls, modes_key, histogram, edges_key, member, score, game_id, default_mode, default_edges)
+    local mode = redis.call('HGET', modes_key, game_id) or default_mode
+    local flag = nil
+    -- min games are stored negated, so keeping the lowest score is keeping the highest board score
+    local sign = 1
+    if mode == 'max' then
+        flag = 'GT'
+    elseif mode == 'min' then
+        flag, sign = 'GT', -1
+        score = string.format('%.17g', -tonumber(score))
+    end
+
+    -- CH makes ZADD return 1 when the member was added or its score moved
+    local function add(key)
+        if flag then
+            return redis.call('ZADD', key, flag, 'CH', score, member)
+        end
+        return redis.call('ZADD', key, 'CH', score, member)
+    end
+
+    local previous = redis.call('ZSCORE', boards[1], member)
+    local changed = add(boards[1])
+    for i = 2, #boards do
+        changed = changed + add(boards[i])
+        redis.call('EXPIRE', boards[i], ttls[i - 1], 'NX')
+    end
+
+    local current = redis.call('ZSCORE', boards[1], member)
+    if current ~= previous then
+        local edges = redis.call('HGET', edges_key, game_id)
+        if not edges then
+            edges = default_edges
+            redis.call('HSET', edges_key, game_id, edges)
+        end
+        local bounds = {}
+        for edge in string.gmatch(edges, '[^,]+') do
+            table.insert(bounds, tonumber(edge))
+        end
+        -- number of edges <= value, same as histogram_bucket
+        local function bucket(value)
+            local lo, hi = 1, #bounds + 1
+            while lo < hi do
+                local mid = math.floor((lo + hi) / 2)
+                if bounds[mid] <= value then lo = mid + 1 else hi = mid end
+            end
+            return lo - 1
+        end
+        if previous then
+            redis.call('HINCRBY', histogram, bucket(sign * tonumber(previous)), -1)
+        end
+        redis.call('HINCRBY', histogram, bucket(sign * tonumber(current)), 1)
+    end
+    return changed, previous, current, mode
+end
+"""
+
+# one round trip per score: updates the boards, indexes the game for the user and bumps the version.
+# if any board actually changed the game id is published for live viewers.
+# KEYS: all-time board, one per period, user games, version, game modes, histogram, histogram edges
+# ARGV: user id, score, game id, default mode, one ttl per period, default histogram edges, changes channel
+# returns {leaderboard score, 0-based rank, previous score or nil, mode}, scores as stored on the board
+SUBMIT_SCORE_SCRIPT = r_leaderboard.register_script(UPDATE_BOARDS_LUA + """
+local member, game_id = ARGV[1], ARGV[3]
+local periods = #KEYS - 6
+local boards, ttls = {}, {}
+for i = 1, periods + 1 do boards[i] = KEYS[i] end
+for i = 1, periods do ttls[i] = ARGV[4 + i] end
+
+local changed, previous, current, mode = update_boards(boards, ttls, KEYS[periods + 4], KEYS[periods + 5], KEYS[periods + 6],
+                                                       member, ARGV[2], game_id, ARGV[4], ARGV[#ARGV - 1])
+redis.call('SADD', KEYS[periods + 2], game_id)
+redis.call('INCR', KEYS[periods + 3])
+if changed > 0 then
+    redis.call('PUBLISH', ARGV[#ARGV], game_id)
+end
+
+return {current, redis.call('ZREVRANK', KEYS[1], member), previous, mode}
+""")
+
+# the board half of the submit script, run on the user's shard for sharded games. the user's game index,
+# the version and the change notification stay on the main node (see submit_to_shard)
+# KEYS: all-time board, one per period, game modes, histogram, histogram edges
+# ARGV: user id, score, game id, default mode, one ttl per period, default histogram edges
+# returns {leaderboard score, boards changed, previous score or nil, mode}, scores as stored on the board
+SHARD_SUBMIT_SCORE_SCRIPT = r_leaderboard.register_script(UPDATE_BOARDS_LUA + """
+local periods = #KEYS - 4
+local boards, ttls = {}, {}
+for i = 1, periods + 1 do boards[i] = KEYS[i] end
+for i = 1, periods do ttls[i] = ARGV[4 + i] end
+
+local changed, previous, current, mode = update_boards(boards, ttls, KEYS[periods + 2], KEYS[periods + 3], KEYS[periods + 4],
+                                                       ARGV[1], ARGV[2], ARGV[3], ARGV[4], ARGV[#ARGV])
+return {current, changed, previous, mode}
+""")
+
+# queues the submit script on a pipeline, or runs it when given the client
+async def queue_score_submission(client, game_id, user_id, score: float, when: datetime):
+    keys = [leaderboard_key(game_id)]
+    keys += [leaderboard_key(game_id, period, when) for period in PERIODS]
+    keys += [user_games_key(user_id), version_key(game_id), GAME_MODES_KEY, histogram_key(game_id), HISTOGRAM_EDGES_KEY]
+    args = [user_id, score, game_id, DEFAULT_SCORE_MODE]
+    args += [int(ttl.total_seconds()) for _, ttl in PERIODS.values()]
+    args += [SCORE_HISTOGRAM_EDGES, LEADERBOARD_CHANGES_CHANNEL]
+    return await SUBMIT_SCORE_SCRIPT(keys=keys, args=args, client=client)
+
+# the sharded counterpart of queue_score_submission, returns a reply shaped like the submit script's.
+# the board update runs on the user's shard, then the bookkeeping on the main node and the rank on every shard in parallel
+async def submit_to_shard(game_id, user_id, score: float, when: datetime):
+    keys = [leaderboard_key(game_id)]
+    keys += [leaderboard_key(game_id, period, when) for period in PERIODS]
+    keys += [GAME_MODES_KEY, histogram_key(game_id), HISTOGRAM_EDGES_KEY]
+    args = [user_id, score, game_id, DEFAULT_SCORE_MODE]
+    args += [int(ttl.total_seconds()) for _, ttl in PERIODS.values()]
+    args += [SCORE_HISTOGRAM_EDGES]
+    current, changed, previous, mode = await SHARD_SUBMIT_SCORE_SCRIPT(keys=keys, args=args, client=shard_for(user_id))
+
+    pipeline = r_leaderboard.pipeline(transaction=False)
+    pipeline.sadd(user_games_key(user_id), game_id)
+    pipeline.incr(version_key(game_id))
+    if int(changed) > 0:
+        pipeline.publish(LEADERBOARD_CHANGES_CHANNEL, game_id)
+    _, rank = await asyncio.gather(pipeline.execute(), sharded_rank(leaderboard_key(game_id), current, str(user_id)))
+    return [current, rank - 1, previous, mode]
+
+# script reply -> {"leaderboard_score", "rank", "previous_best"}, rank is ordinal and scores are real scores
+def parse_submission(result):
+    leaderboard_score, rank, previous, mode = result
+    return {"leaderboard_score": board_score(float(leaderboard_score), mode),
+            "rank": int(rank) + 1,
+            "previous_best": board_score(float(previous), mode) if previous is not None else None}
+
+# do not use directly
+@redis_timed
+async def submit_score(score: ScorePublic, user_id, when: datetime | None = None):
+    if is_sharded(score.game_id):
+        result = await submit_to_shard(score.game_id, user_id, score.score, when or datetime.utcnow())
+    else:
+        result = await queue_score_submission(r_leaderboard, score.game_id, user_id, score.score, when or datetime.utcnow())
+    return parse_submission(result)
+
+# to be used. the time is pinned here so a queued retry lands on the periodic boards of the original submission
+async def retry_submit_score(score:ScorePublic, user_id, when: datetime | None = None):
+    return await retry_cache_operation(submit_score, score, user_id, when or datetime.utcnow())
+
+
+## 2.1.1 submit a batch of scores ##
+
 # do not use directly
-def submit_score(score: ScorePublic, user_id):
-    r_leaderboard.zadd(score.game_id, {user_id: score.score})
+# one script call per row in a single pipeline, applied in the order given. rows for sharded games go to their shards
+# concurrently with it. returns the parsed submission per row, or None where that row failed and was queued for retry
+@redis_timed
+async def submit_score_batch(scores, when: datetime):
+    sharded = [i for i, score in enumerate(scores) if is_sharded(score.game_id)]
+    pipeline = r_leaderboard.pipeline(transaction=False)
+    for i, score in enumerate(scores):
+        if not is_sharded(score.game_id):
+            await queue_score_submission(pipeline, score.game_id, score.user_id, score.score, when)
+
+    # a failure on one row should not hide the rows that were written
+    pipeline_results, *shard_results = await asyncio.gather(
+        pipeline.execute(raise_on_error=False),
+        *(submit_to_shard(scores[i].game_id, scores[i].user_id, scores[i].score, when) for i in sharded),
+        return_exceptions=True)
+    if isinstance(pipeline_results, Exception):
+        raise pipeline_results
+    shard_results = dict(zip(sharded, shard_results))
+    pipeline_results = iter(pipeline_results)
+    results = [shard_results[i] if i in shard_results else next(pipeline_results) for i in range(len(scores))]
+
+    submissions = []
+    for score, result in zip(scores, results):
+        if isinstance(result, Exception):
+            # the row is already in postgres, so its board update is retried like a single score's
+            logger.error(f"Failed to add batch score for user {score.user_id} game {score.game_id}, queued for retry: {result}")
+            if is_sharded(score.game_id):
+                queue_retry(submit_to_shard, score.game_id, score.user_id, score.score, when)
+            else:
+                queue_retry(queue_score_submission, r_leaderboard, score.game_id, score.user_id, score.score, when)
+            submissions.append(None)
+        else:
+            submissions.append(parse_submission(result))
+    return submissions
 
 # to be used
-def retry_submit_score(score:ScorePublic, user_id):
-    retry_cache_operation(submit_score, score, user_id)
+async def retry_submit_score_batch(scores, when: datetime):
+    return await retry_cache_operation(submit_score_batch, scores, when)
+
+
+## 2.1.2 write-behind submission ##
+
+# in write-behind mode redis is the durable write on the request path: the leaderboard update and
+# an entry on the score stream go in one MULTI. data/synchronisation.py flushes the stream to postgres.
+SCORE_STREAM = 'scores:stream'
+SCORE_STREAM_GROUP = 'score-flusher'
+
+# do not use directly
+# a MULTI cannot span nodes, so rows for sharded games are applied on their shards first and only their stream
+# entries join the MULTI. if the MULTI then fails, the retry applies them again, which every score mode tolerates.
+# returns (parsed submission, stream id) in the order of scores
+@redis_timed
+async def submit_score_write_behind(scores, date_added):
+    sharded = [i for i, score in enumerate(scores) if is_sharded(score.game_id)]
+    shard_results = dict(zip(sharded, await asyncio.gather(
+        *(submit_to_shard(scores[i].game_id, scores[i].user_id, scores[i].score, date_added) for i in sharded))))
+
+    pipeline = r_leaderboard.pipeline(transaction=True)
+    for i, score in enumerate(scores):
+        if i not in shard_results:
+            await queue_score_submission(pipeline, score.game_id, score.user_id, score.score, date_added)
+        pipeline.xadd(SCORE_STREAM, {"user_id": score.user_id, "game_id": score.game_id,
+                                     "score": score.score, "date_added": date_added.isoformat()})
+
+    results = iter(await pipeline.execute())
+    submissions = []
+    for i in range(len(scores)):
+        submission = shard_results[i] if i in shard_results else next(results)
+        submissions.append((parse_submission(submission), next(results)))
+    return submissions
+
+# to be used. the stream entry is the only copy of the score, so a failure is not queued: it goes back to the
+# client to resubmit
+async def retry_submit_score_write_behind(scores, date_added):
+    return await submit_score_write_behind(scores, date_added)
+
+
+## 2.1.3 game score mode ##
+
+# a game's mode never changes once it is created, so each process keeps the ones it has read
+game_modes: dict[str, str] = {}
+
+# mirrored onto the shards of a sharded game, their submit script reads it there
+@redis_timed
+async def set_game_mode(game_id, score_mode: str):
+    game_modes[str(game_id)] = score_mode
+    if is_sharded(game_id):
+        await asyncio.gather(*(client.hset(GAME_MODES_KEY, game_id, score_mode) for client in shard_clients))
+    return await r_leaderboard.hset(GAME_MODES_KEY, game_id, score_mode)
+
+async def retry_set_game_mode(game_id, score_mode: str):
+    await retry_cache_operation(set_game_mode, game_id, score_mode)
+
+# the mode the submit script applies, DEFAULT_SCORE_MODE for a game it has not been set for
+async def get_game_mode(game_id) -> str:
+    mode = game_modes.get(str(game_id))
+    if mode is None:
+        mode = await r_leaderboard.hget(GAME_MODES_KEY, game_id)
+        if mode is None:
+            return DEFAULT_SCORE_MODE
+        game_modes[str(game_id)] = mode
+    return mode
+
+# real score <-> board score, the same negation both ways. (-0.0 is shown as 0.0)
+def board_score(score: float, mode: str) -> float:
+    return (-score or 0.0) if mode == 'min' else score
+
+# the same for the score at the end of each entry, e.g. (member, score) or (rank, member, score)
+def board_scores(entries, mode: str):
+    if mode != 'min':
+        return entries
+    return [(*entry[:-1], board_score(entry[-1], mode)) for entry in entries]
 
 
 ## 2.2 retrieve user's ranking for a game ##
 
 # retrieves the user's rank and score for a single game
-def retrieve_ranking(user_id: int, game_id:int):
-    rank = r_leaderboard.zrevrank(game_id, user_id) 
-    print('raw rank', rank)
-    score = r_leaderboard.zscore(game_id, user_id)
+@redis_timed
+async def retrieve_ranking(user_id: int, game_id:int, period: Period | None = None):
+    key = leaderboard_key(game_id, period)
+    mode = await get_game_mode(game_id)
+    if is_sharded(game_id):
+        score = await shard_for(user_id).zscore(key, user_id)
+        if score is None:
+            return (None, score)
+        return (await sharded_rank(key, score, str(user_id)), board_score(score, mode))
+    rank = await r_leaderboard.zrevrank(key, user_id) 
+    score = await r_leaderboard.zscore(key, user_id)
+    # user has no entry for this game
+    if rank is None:
+        return (None, score)
     rank_int = int(rank) + 1
-    return (rank_int, score)
+    return (rank_int, board_score(score, mode))
 
 
 ## 2.3 retrieve leaders for a game ##
 
 # retrieves the leaderboard for a single game
-def retrieve_leaders(game_id: int, start : int, end : int):
-    return r_leaderboard.zrevrange(game_id, start, end, withscores=True)
+@redis_timed
+async def retrieve_leaders(game_id: int, start : int, end : int, period: Period | None = None):
+    mode = await get_game_mode(game_id)
+    if is_sharded(game_id):
+        return board_scores(await retrieve_sharded_leaders(game_id, start, end, period), mode)
+    return board_scores(await r_leaderboard.zrevrange(leaderboard_key(game_id, period), start, end, withscores=True), mode)
 
 
 # retrieves the leaderboard for a single game
-def retrieve_leaders_no_score(game_id: int, start : int, end : int):
-    return r_leaderboard.zrevrange(game_id, start, end)
+@redis_timed
+async def retrieve_leaders_no_score(game_id: int, start : int, end : int, period: Period | None = None):
+    if is_sharded(game_id):
+        return [member for member, _ in await retrieve_sharded_leaders(game_id, start, end, period)]
+    return await r_leaderboard.zrevrange(leaderboard_key(game_id, period), start, end)
+
+
+# any of the global top end+1 can sit on any shard, so each shard gives its own top end+1 and they are merged.
+# cost grows with end, use cursor pages (2.3.2) to go deep
+async def retrieve_sharded_leaders(game_id: int, start: int, end: int, period: Period | None = None):
+    key = leaderboard_key(game_id, period)
+    merged = merge_shards(await asyncio.gather(*(client.zrevrange(key, 0, end, withscores=True) for client in shard_clients)))
+    return merged[start:] if end < 0 else merged[start:end + 1]
+
+
+## 2.3.1 players around a user ##
+
+# the user's rank and the window of players around it in one round trip
+# KEYS: board   ARGV: user id, players either side
+# returns {0-based rank of the first entry, flat member/score list} or nil if the user is not on the board
+NEIGHBOURS_SCRIPT = r_leaderboard.register_script("""
+local rank = redis.call('ZREVRANK', KEYS[1], ARGV[1])
+if not rank then
+    return nil
+end
+local first = math.max(rank - tonumber(ARGV[2]), 0)
+return {first, redis.call('ZREVRANGE', KEYS[1], first, rank + tonumber(ARGV[2]), 'WITHSCORES')}
+""")
+
+# returns (ordinal rank, [(rank, user_id, score)]) or (None, []) if the user has no entry
+@redis_timed
+async def retrieve_neighbours(user_id: int, game_id: int, radius: int, period: Period | None = None):
+    mode = await get_game_mode(game_id)
+    if is_sharded(game_id):
+        rank, entries = await retrieve_sharded_neighbours(user_id, game_id, radius, period)
+        return (rank, board_scores(entries, mode))
+    result = await NEIGHBOURS_SCRIPT(keys=[leaderboard_key(game_id, period)], args=[user_id, radius])
+    if result is None:
+        return (None, [])
+    first, flat = result
+    entries = [(int(first) + i + 1, flat[2 * i], float(flat[2 * i + 1])) for i in range(len(flat) // 2)]
+    rank = next(rank for rank, member, _ in entries if member == str(user_id))
+    return (rank, board_scores(entries, mode))
+
+
+# the members just before and just after (score, member) on one shard, in board order
+# KEYS: board   ARGV: score, member, players either side
+# returns {members ahead, flat member/score list before, flat member/score list after}
+WINDOW_SCRIPT = r_leaderboard.register_script(BOARD_POSITION_LUA + """
+local radius = tonumber(ARGV[3])
+local count, found = ahead(KEYS[1], ARGV[1], ARGV[2])
+local before, after = {}, {}
+if count > 0 then
+    before = redis.call('ZREVRANGE', KEYS[1], math.max(count - radius, 0), count - 1, 'WITHSCORES')
+end
+local first = found and count + 1 or count
+after = redis.call('ZREVRANGE', KEYS[1], first, first + radius - 1, 'WITHSCORES')
+return {count, before, after}
+""")
+
+# each shard gives its radius players either side of the user in board order, the merged lists are cut to radius
+# either side. the rank is the sum of the members ahead on each shard, the same as sharded_rank
+async def retrieve_sharded_neighbours(user_id: int, game_id: int, radius: int, period: Period | None = None):
+    key = leaderboard_key(game_id, period)
+    score = await shard_for(user_id).zscore(key, user_id)
+    if score is None:
+        return (None, [])
+
+    args = [repr(float(score)), str(user_id), radius]
+    windows = await asyncio.gather(*(WINDOW_SCRIPT(keys=[key], args=args, client=client) for client in shard_clients))
+    def pairs(flat):
+        return [(flat[2 * i], float(flat[2 * i + 1])) for i in range(len(flat) // 2)]
+
+    rank = 1 + sum(int(count) for count, _, _ in windows)
+    above = merge_shards(pairs(before) for _, before, _ in windows)[-radius:] if radius else []
+    below = merge_shards(pairs(after) for _, _, after in windows)[:radius]
+
+    entries = [(rank - len(above) + i, member, member_score) for i, (member, member_score) in enumerate(above)]
+    entries.append((rank, str(user_id), score))
+    entries += [(rank + i + 1, member, member_score) for i, (member, member_score) in enumerate(below)]
+    return (rank, entries)
+
+
+## 2.3.2 cursor pages ##
+
+# the page after a (score, member) cursor. boards order ties by member descending, so the cursor is the last entry sent.
+# the page starts past the cursor's position (see ahead() in 2.0.1), and past the cursor member if it is still there
+# KEYS: board   ARGV: cursor score, cursor member, page size
+# returns {0-based rank of the first entry, flat member/score list}
+CURSOR_PAGE_SCRIPT = r_leaderboard.register_script(BOARD_POSITION_LUA + """
+local key, size = KEYS[1], tonumber(ARGV[3])
+local start, found = ahead(key, ARGV[1], ARGV[2])
+if found then
+    start = start + 1
+end
+return {start, redis.call('ZREVRANGE', key, start, start + size - 1, 'WITHSCORES')}
+""")
+
+# returns [(rank, user_id, score)], starting from the top when there is no cursor. the cursor holds a real score
+@redis_timed
+async def retrieve_leaders_after(game_id: int, cursor: tuple[float, str] | None, size: int, period: Period | None = None):
+    key = leaderboard_key(game_id, period)
+    mode = await get_game_mode(game_id)
+    if cursor is not None:
+        cursor = (board_score(cursor[0], mode), cursor[1])
+    if is_sharded(game_id):
+        return board_scores(await retrieve_sharded_leaders_after(key, cursor, size), mode)
+    return board_scores(await leaders_after(key, cursor, size), mode)
+
+
+async def leaders_after(key, cursor: tuple[float, str] | None, size: int):
+    if cursor is None:
+        leaders = await r_leaderboard.zrevrange(key, 0, size - 1, withscores=True)
+        return [(i + 1, member, score) for i, (member, score) in enumerate(leaders)]
+    score, member = cursor
+    first, flat = await CURSOR_PAGE_SCRIPT(keys=[key], args=[repr(float(score)), member, size])
+    return [(int(first) + i + 1, flat[2 * i], float(flat[2 * i + 1])) for i in range(len(flat) // 2)]
+
+
+# the same cursor on every shard, each shard's start is how many of its members sort before the cursor,
+# so their sum is the exact global offset of the merged page
+async def retrieve_sharded_leaders_after(key, cursor: tuple[float, str] | None, size: int):
+    if cursor is None:
+        pages = await asyncio.gather(*(client.zrevrange(key, 0, size - 1, withscores=True) for client in shard_clients))
+        first = 0
+    else:
+        score, member = cursor
+        replies = await asyncio.gather(*(CURSOR_PAGE_SCRIPT(keys=[key], args=[repr(float(score)), member, size], client=client)
+                                         for client in shard_clients))
+        first = sum(int(start) for start, _ in replies)
+        pages = [[(flat[2 * i], float(flat[2 * i + 1])) for i in range(len(flat) // 2)] for _, flat in replies]
+    return [(first + i + 1, member, score) for i, (member, score) in enumerate(merge_shards(pages)[:size])]
+
+
+## 2.3.3 score distribution ##
+
+# returns (edges, count per bucket). two hash reads, independent of the number of players.
+# sharded games keep a histogram per shard on the same edges, the counts are summed
+@redis_timed
+async def get_score_histogram(game_id: int):
+    async def read(client):
+        pipeline = client.pipeline(transaction=False)
+        pipeline.hget(HISTOGRAM_EDGES_KEY, game_id)
+        pipeline.hgetall(histogram_key(game_id))
+        return await pipeline.execute()
+
+    replies = await asyncio.gather(*(read(client) for client in board_clients(game_id)))
+    edges = next((edges for edges, _ in replies if edges), None)
+    edges = [float(edge) for edge in edges.split(',')] if edges else DEFAULT_HISTOGRAM_EDGES
+    buckets = [0] * (len(edges) + 1)
+    for _, counts in replies:
+        for bucket, count in counts.items():
+            buckets[int(bucket)] += int(count)
+    return edges, buckets
+
+
+# approximate ordinal rank of a score from the histogram, assuming scores spread evenly within a bucket.
+# the players ahead are those in the buckets above, or below for a min game.
+# returns (rank, total players), rank is None on an empty board
+def histogram_rank(edges: list[float], buckets: list[int], score: float, score_mode: str = DEFAULT_SCORE_MODE):
+    total = sum(buckets)
+    if total == 0:
+        return (None, 0)
+    bucket = histogram_bucket(edges, score)
+    lowest_first = score_mode == 'min'
+    ahead = sum(buckets[:bucket]) if lowest_first else sum(buckets[bucket + 1:])
+    # open-ended first and last buckets have no width, count the score as halfway
+    share_ahead = 0.5
+    if 0 < bucket < len(edges):
+        low, high = edges[bucket - 1], edges[bucket]
+        share_ahead = ((score - low) if lowest_first else (high - score)) / (high - low)
+    rank = ahead + round(buckets[bucket] * share_ahead) + 1
+    return (min(rank, total), total)
+
+
+# the user's all-time score alongside the game's histogram, or None if they have no entry
+@redis_timed
+async def retrieve_score_and_histogram(user_id: int, game_id: int):
+    client = shard_for(user_id) if is_sharded(game_id) else r_leaderboard
+    score = await client.zscore(leaderboard_key(game_id), user_id)
+    if score is None:
+        return None
+    return (board_score(score, await get_game_mode(game_id)), *await get_score_histogram(game_id))
+
+
+## 2.3.4 full export ##
+
+# rows per read while exporting a whole board, the only part of it held in memory
+EXPORT_CHUNK_SIZE = config('EXPORT_CHUNK_SIZE', default=1000, cast=int)
+# a snapshot copy outlives an export that dies before deleting it by at most this long
+EXPORT_SNAPSHOT_TTL = config('EXPORT_SNAPSHOT_TTL', default=3600, cast=int)
+
+# yields the whole board as [(rank, user_id, score)] chunks in board order.
+# live exports walk the board by cursor, so players moving during the export are neither repeated nor skipped
+# unless they themselves move. snapshot exports COPY the board (on every shard) first and read the copy
+# with plain ZREVRANGE offsets, every row then comes from the same instant
+async def export_leaders(game_id: int, period: Period | None = None, snapshot: bool = False,
+                         chunk_size: int = EXPORT_CHUNK_SIZE):
+    key = leaderboard_key(game_id, period)
+    clients = board_clients(game_id)
+    mode = await get_game_mode(game_id)
+    if snapshot:
+        snapshot_key = f'export:{key}:{uuid4().hex}'
+
+        async def copy_board(client):
+            pipeline = client.pipeline(transaction=True)
+            pipeline.copy(key, snapshot_key)
+            pipeline.expire(snapshot_key, EXPORT_SNAPSHOT_TTL)
+            await pipeline.execute()
+        await asyncio.gather(*(copy_board(client) for client in clients))
+        key = snapshot_key
+
+    try:
+        cursor, start = None, 0
+        while True:
+            if is_sharded(game_id):
+                chunk = await retrieve_sharded_leaders_after(key, cursor, chunk_size)
+            elif snapshot:
+                leaders = await r_leaderboard.zrevrange(key, start, start + chunk_size - 1, withscores=True)
+                chunk = [(start + i + 1, member, score) for i, (member, score) in enumerate(leaders)]
+            else:
+                chunk = await leaders_after(key, cursor, chunk_size)
+            if chunk:
+                yield board_scores(chunk, mode)
+            if len(chunk) < chunk_size:
+                return
+            cursor, start = (chunk[-1][2], chunk[-1][1]), start + len(chunk)
+    finally:
+        if snapshot:
+            await asyncio.gather(*(client.delete(key) for client in clients))
+
+
+## 2.4 leaderboard version ##
+
+@redis_timed
+async def get_leaderboard_version(game_id: int):
+    return int(await r_leaderboard.get(version_key(game_id)) or 0)
+
+
+# usernames are part of every page the user is on, so a rename moves the version of each game they have played
+# (and wakes its live viewers) instead of leaving etags and cached pages with the old name until the next score
+@redis_timed
+async def bump_user_game_versions(user_id):
+    game_ids = await r_leaderboard.smembers(user_games_key(user_id))
+    if not game_ids:
+        return
+    pipeline = r_leaderboard.pipeline(transaction=False)
+    for game_id in game_ids:
+        pipeline.incr(version_key(game_id))
+        pipeline.publish(LEADERBOARD_CHANGES_CHANNEL, game_id)
+    await pipeline.execute()
+
+async def retry_bump_user_game_versions(user_id):
+    await retry_cache_operation(bump_user_game_versions, user_id)
 
 
 
 ### 3. CACHE for id to name lookup - game and user_id ###
 
 
-## 3.1 helper functions ##
+## 3.0 in-process cache ##
+
+# names almost never change, so hot pages are served from process memory in front of r_user / r_game.
+# writing a name publishes it on CACHE_INVALIDATION_CHANNEL and every other api process drops its copy.
+user_name_cache = LocalCache('user_names', config('USER_NAME_CACHE_SIZE', default=100000, cast=int),
+                             config('USER_NAME_CACHE_TTL', default=300, cast=float))
+game_name_cache = LocalCache('game_names', config('GAME_NAME_CACHE_SIZE', default=10000, cast=int),
+                             config('GAME_NAME_CACHE_TTL', default=3600, cast=float))
+
+LOCAL_CACHES = {'user': user_name_cache, 'game': game_name_cache}
+
+CACHE_INVALIDATION_CHANNEL = 'cache:invalidate'
+# messages carry the sender so a process does not drop the value it has just written
+PROCESS_ID = uuid4().hex
+
+
+def invalidation_message(kind: str, id):
+    return f'{kind}:{id}:{PROCESS_ID}'
+
+# for caches whose values change without a redis write of their own (e.g. auth principals)
+@redis_timed
+async def publish_invalidation(kind: str, id):
+    LOCAL_CACHES[kind].invalidate(id)
+    await r_user.publish(CACHE_INVALIDATION_CHANNEL, invalidation_message(kind, id))
+
+
+# runs for the lifetime of the app (started in api/main.py)
+async def listen_for_invalidations():
+    while True:
+        pubsub = r_user.pubsub()
+        try:
+            await pubsub.subscribe(CACHE_INVALIDATION_CHANNEL)
+            # anything published while we were not subscribed is lost, so start clean
+            for cache in LOCAL_CACHES.values():
+                cache.clear()
+            async for message in pubsub.listen():
+                if message['type'] != 'message':
+                    continue
+                # ids may contain ':' (emails), kind and origin never do
+                kind, rest = message['data'].split(':', 1)
+                id, origin = rest.rsplit(':', 1)
+                if origin != PROCESS_ID and kind in LOCAL_CACHES:
+                    LOCAL_CACHES[kind].invalidate(id)
+        except RedisError as e:
+            logger.error(f'Cache invalidation listener lost redis, resubscribing: {e}')
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
+
+
+## 3.0.1 bucketed storage ##
+
+# names are stored in hashes of NAME_CACHE_BUCKET_SIZE ids (users:12 holds ids 1200-1299) rather than a key per id.
+# small hashes use redis's listpack encoding, which costs far less per entry than a top-level key. keep the bucket size
+# under hash-max-listpack-entries (128 by default), names longer than hash-max-listpack-value (64 bytes) convert a bucket.
+NAME_CACHE_BUCKET_SIZE = config('NAME_CACHE_BUCKET_SIZE', default=100, cast=int)
+USER_NAME_PREFIX = 'users'
+GAME_NAME_PREFIX = 'games'
+
+def name_bucket_key(prefix: str, id):
+    return f'{prefix}:{int(id) // NAME_CACHE_BUCKET_SIZE}'
+
+
+## 3.1 helper functions ##
 
 # base functions for setting cache
-def set_user_cache(username : str, id : str):
-    return r_user.set(id, username)
+@redis_timed
+async def set_user_cache(username : str, id : str):
+    pipeline = r_user.pipeline(transaction=False)
+    pipeline.hset(name_bucket_key(USER_NAME_PREFIX, id), id, username)
+    pipeline.publish(CACHE_INVALIDATION_CHANNEL, invalidation_message('user', id))
+    await pipeline.execute()
+    user_name_cache.set(id, username)
 
-def set_game_cache(game_name : str, id : str):
-    return r_game.set(id, game_name)
+@redis_timed
+async def set_game_cache(game_name : str, id : str):
+    pipeline = r_game.pipeline(transaction=False)
+    pipeline.hset(name_bucket_key(GAME_NAME_PREFIX, id), id, game_name)
+    pipeline.publish(CACHE_INVALIDATION_CHANNEL, invalidation_message('game', id))
+    await pipeline.execute()
+    game_name_cache.set(id, game_name)
 
 
 
 ## 3.2 set and get functions for cache ##
 
-def retry_set_user_cache(username : str, id : str):
-    retry_cache_operation(set_user_cache, username, id)
+async def retry_set_user_cache(username : str, id : str):
+    await retry_cache_operation(set_user_cache, username, id)
 
-def retry_set_game_cache(game_name : str, id : str):
-    retry_cache_operation(set_game_cache, game_name, id)
+async def retry_set_game_cache(game_name : str, id : str):
+    await retry_cache_operation(set_game_cache, game_name, id)
 
-def get_user_cache(id : str):
-    return r_user.get(id)
+# local cache first, then one HMGET per bucket for whatever it did not have, all in one pipeline
+async def get_cached_names(local_cache: LocalCache, client, prefix: str, ids):
+    names = [local_cache.get(id) for id in ids]
+    missing_by_bucket = {}
+    for i, name in enumerate(names):
+        if name is None:
+            missing_by_bucket.setdefault(name_bucket_key(prefix, ids[i]), []).append(i)
+    missing = sum(len(positions) for positions in missing_by_bucket.values())
+    NAME_CACHE_LOOKUPS.labels(local_cache.name, 'local').inc(len(ids) - missing)
+    if not missing_by_bucket:
+        return names
 
-def get_game_cache(id : str):
-    return r_game.get(id)
+    pipeline = client.pipeline(transaction=False)
+    for bucket, positions in missing_by_bucket.items():
+        pipeline.hmget(bucket, [ids[i] for i in positions])
+    fetched = await pipeline.execute()
 
-def get_multiple_usernames(list_user_ids):
-    pipeline = r_user.pipeline()
+    for positions, bucket_names in zip(missing_by_bucket.values(), fetched):
+        for i, name in zip(positions, bucket_names):
+            names[i] = name
+            local_cache.set(ids[i], name)
+            NAME_CACHE_LOOKUPS.labels(local_cache.name, 'redis' if name is not None else 'miss').inc()
+    return names
 
-    for key in list_user_ids:
-        pipeline.get(key)
+@redis_timed
+async def get_user_cache(id : str):
+    return (await get_cached_names(user_name_cache, r_user, USER_NAME_PREFIX, [id]))[0]
 
-    results = pipeline.execute()
-    return results
+@redis_timed
+async def get_game_cache(id : str):
+    return (await get_cached_names(game_name_cache, r_game, GAME_NAME_PREFIX, [id]))[0]
 
+@redis_timed
+async def get_multiple_game_names(list_game_ids):
+    return await get_cached_names(game_name_cache, r_game, GAME_NAME_PREFIX, list_game_ids)
 
-def add_multiple_usernames(list_user_data):
+@redis_timed
+async def get_multiple_usernames(list_user_ids):
+    return await get_cached_names(user_name_cache, r_user, USER_NAME_PREFIX, list_user_ids)
+
+
+# fills the cache from postgres, the names themselves have not changed so nothing is published
+@redis_timed
+async def add_multiple_usernames(list_user_data):
     pipeline = r_user.pipeline()
 
     for item in list_user_data:
-        pipeline.set(item[0], item[1])
+        pipeline.hset(name_bucket_key(USER_NAME_PREFIX, item[0]), item[0], item[1])
         
-    results = pipeline.execute()
+    results = await pipeline.execute()
+    for id, username in list_user_data:
+        user_name_cache.set(id, username)
     return results
 
 
-# 4.0 get users ranking for all games
-def user_data_all_games(user_id : int):
-    pass
-    # get all game ids from redis
-    cursor = 0
-    game_keys = []
 
-    while True:
-        cursor, keys = r_leaderboard.scan(cursor, match='*', count=1000, _type='zset')
-        game_keys.extend(keys)
-        if cursor == 0:
-            break
-    
-    # return None if no game keys found in redis
-    if game_keys == []:
-        logger.warning(f"No game id keys found in redis. User concerned is {user_id}")
-        return None 
-    
-    # create a pipeline to retrieve the user's rankings
-    pipeline = r_leaderboard.pipeline()
-
-    for key in game_keys:
-        pipeline.zrevrank(key, user_id)
-
-    results = pipeline.execute()
-
-    # need to add 1 to get in ordinal complaint format 
-    results_adjusted = [result + 1 for result in results if result is not None]
-
-    user_rankings = {key : result for (key, result) in zip(game_keys, results_adjusted)}
-
-    return user_rankings
+## 3.3 player profiles ##
+
+# the fields the top players report shows, as json in bucketed hashes next to the names (profiles:12 holds ids 1200-1299).
+# filled from postgres on a miss and dropped when the profile changes
+PROFILE_PREFIX = 'profiles'
+
+# returns a profile dict or None per id, one HMGET per bucket in a single pipeline
+@redis_timed
+async def get_player_profiles(ids):
+    by_bucket = {}
+    for i, id in enumerate(ids):
+        by_bucket.setdefault(name_bucket_key(PROFILE_PREFIX, id), []).append(i)
+    if not by_bucket:
+        return []
+
+    pipeline = r_user.pipeline(transaction=False)
+    for bucket, positions in by_bucket.items():
+        pipeline.hmget(bucket, [ids[i] for i in positions])
+    fetched = await pipeline.execute()
+
+    profiles = [None] * len(ids)
+    for positions, bucket_profiles in zip(by_bucket.values(), fetched):
+        for i, profile in zip(positions, bucket_profiles):
+            profiles[i] = json.loads(profile) if profile is not None else None
+    return profiles
+
+
+# profiles: {user id: profile dict}
+@redis_timed
+async def set_player_profiles(profiles: dict):
+    pipeline = r_user.pipeline(transaction=False)
+    for id, profile in profiles.items():
+        pipeline.hset(name_bucket_key(PROFILE_PREFIX, id), id, json.dumps(profile, default=str))
+    await pipeline.execute()
+
+
+@redis_timed
+async def invalidate_player_profile(id):
+    await r_user.hdel(name_bucket_key(PROFILE_PREFIX, id), id)
+
+
+## 3.4 top players report ##
+
+# the serialised report per game and period. kept for a few seconds rather than versioned, so under load the report
+# costs one GET and only a miss reads the board and profiles
+REPORT_CACHE_TTL = config('REPORT_CACHE_TTL', default=30, cast=int)
+
+def report_key(game_id, period: Period | None = None):
+    return f'report:{game_id}:{(period or Period.all).value}'
+
+@redis_timed
+async def get_cached_report(game_id, period: Period | None = None):
+    return await r_leaderboard.get(report_key(game_id, period))
+
+@redis_timed
+async def set_cached_report(game_id, period: Period | None, body: str):
+    await r_leaderboard.set(report_key(game_id, period), body, ex=REPORT_CACHE_TTL)
+
+
+# 4.0 get users ranking for all games
+
+# ranks the user on each of the given boards and returns a flat [game_id, rank, score, mode, ...] list for the games
+# they are still ranked in, with the mode from the game modes hash (false when unset). one round trip however many games.
+# KEYS: game modes, one board per game   ARGV: user id, the game id of each board
+USER_RANKINGS_SCRIPT = r_leaderboard.register_script("""
+local results = {}
+for i = 2, #KEYS do
+    local rank = redis.call('ZREVRANK', KEYS[i], ARGV[1])
+    if rank then
+        table.insert(results, ARGV[i])
+        table.insert(results, rank)
+        table.insert(results, redis.call('ZSCORE', KEYS[i], ARGV[1]))
+        table.insert(results, redis.call('HGET', KEYS[1], ARGV[i]))
+    end
+end
+return results
+""")
+
+# returns [(game_id, rank, score)] sorted by game id, or None if the user has no rankings
+@redis_timed
+async def user_data_all_games(user_id : int):
+    # the game index is read first so the script is handed every key it touches
+    game_ids = await r_leaderboard.smembers(user_games_key(user_id))
+    main_games = [game_id for game_id in game_ids if not is_sharded(game_id)]
+    sharded_games = [game_id for game_id in game_ids if is_sharded(game_id)]
+
+    user_rankings = []
+    if main_games:
+        results = await USER_RANKINGS_SCRIPT(keys=[GAME_MODES_KEY, *(leaderboard_key(game_id) for game_id in main_games)],
+                                             args=[user_id, *main_games])
+        # need to add 1 to get in ordinal complaint format 
+        user_rankings = [(results[i], int(results[i + 1]) + 1, board_score(float(results[i + 2]), results[i + 3]))
+                         for i in range(0, len(results), 4)]
+
+    # sharded games the user plays are ranked on their shards
+    for game_id, (rank, score) in zip(sharded_games, await asyncio.gather(
+            *(retrieve_ranking(user_id, game_id) for game_id in sharded_games))):
+        if rank is not None:
+            user_rankings.append((str(game_id), rank, score))
+
+    if not user_rankings:
+        logger.warning(f"No rankings found in redis for user {user_id}")
+        return None
+
+    return sorted(user_rankings, key=lambda ranking: int(ranking[0]))
 
 
 # 5.0 get leaders for a game
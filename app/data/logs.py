@@ -0,0 +1,125 @@
+import atexit
+import logging
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener
+from decouple import config
+
+
+#### LOGGING ####
+
+# one logging setup per process, called from the entry points (api/main.py, data/synchronisation.py).
+# records go onto a bounded queue and a listener thread does the formatting and the console / file writes,
+# so a slow disk or a busy stdout never holds up a request. per call site rate limits keep per-request
+# messages from flooding the queue when something fails on every request
+
+
+### 0. SETTINGS ###
+
+LOG_LEVEL = config('LOG_LEVEL', default='INFO')
+# per logger overrides, e.g. "data.leaderboard=DEBUG,httpx=WARNING"
+LOG_LEVELS = config('LOG_LEVELS', default='httpx=WARNING')
+# empty to log to the console only
+LOG_FILE = config('LOG_FILE', default='app.log')
+LOG_FORMAT = config('LOG_FORMAT', default='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+# records waiting for the listener thread. when full, new records are dropped and counted rather than waited on
+LOG_QUEUE_SIZE = config('LOG_QUEUE_SIZE', default=10000, cast=int)
+# records let through per call site per LOG_RATE_WINDOW seconds, 0 for no limit
+LOG_RATE_LIMIT = config('LOG_RATE_LIMIT', default=10, cast=int)
+LOG_RATE_WINDOW = config('LOG_RATE_WINDOW', default=1.0, cast=float)
+
+
+### 1. RATE LIMITING ###
+
+# a call site is the logger and line, so a message logged on every request counts once however its text varies.
+# what was held back is reported on the next record let through from the same site
+class RateLimitFilter(logging.Filter):
+    def __init__(self, limit: int = LOG_RATE_LIMIT, window: float = LOG_RATE_WINDOW):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        # (logger, line) -> [window start, records in window, suppressed]
+        self.sites: dict[tuple[str, int], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.limit <= 0:
+            return True
+        now = time.monotonic()
+        site = self.sites.get((record.name, record.lineno))
+        if site is None or now - site[0] >= self.window:
+            suppressed = site[2] if site is not None else 0
+            self.sites[(record.name, record.lineno)] = [now, 1, 0]
+            if suppressed:
+                record.msg = f'{record.msg} ({suppressed} similar suppressed)'
+            return True
+        if site[1] < self.limit:
+            site[1] += 1
+            return True
+        site[2] += 1
+        return False
+
+
+### 2. QUEUE ###
+
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    # put_nowait on a full queue would otherwise end up in handleError and print a traceback per record
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+listener = None
+queue_handler = None
+
+
+### 3. SETUP ###
+
+def parse_levels(levels: str) -> dict[str, str]:
+    return dict(item.strip().split('=', 1) for item in levels.split(',') if '=' in item)
+
+
+# safe to call more than once, only the first call sets anything up. a process that configured the root
+# logger itself (the benchmarks) keeps its own handlers
+def setup_logging():
+    global listener, queue_handler
+    if listener is not None or logging.getLogger().handlers:
+        return
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if LOG_FILE:
+        handlers.append(logging.FileHandler(LOG_FILE))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    queue_handler = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    queue_handler.addFilter(RateLimitFilter())
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL.upper())
+    root.addHandler(queue_handler)
+    for name, level in parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # flushes whatever is still queued on a normal exit
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+def logging_stats():
+    if queue_handler is None:
+        return {}
+    return {"queued": queue_handler.queue.qsize(), "dropped": queue_handler.dropped}
@@ -0,0 +1,174 @@
+import time
+from contextvars import ContextVar
+from functools import wraps
+import redis.asyncio as redis
+from redis.asyncio.client import Pipeline
+from prometheus_client import Counter, Histogram, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from sqlalchemy import event
+from data.cache import CACHES
+
+
+#### METRICS ####
+
+# prometheus metrics for the hot paths, served as text from GET /metrics.
+# everything is recorded in-process, scrape each api worker separately
+
+
+### 1. HTTP ###
+
+HTTP_REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'Request latency by route template',
+                                 ['method', 'route', 'status'])
+
+# route is the template (/users/{user_id}/ranking) so ids do not blow up the label set
+def observe_request(method: str, route: str, status: int, seconds: float):
+    HTTP_REQUEST_SECONDS.labels(method, route, str(status)).observe(seconds)
+
+
+### 2. REDIS ###
+
+REDIS_CALL_SECONDS = Histogram('redis_call_duration_seconds', 'Latency of data layer functions that talk to redis',
+                               ['function'])
+REDIS_CALL_ERRORS = Counter('redis_call_errors_total', 'Data layer redis calls that raised', ['function'])
+REDIS_COMMANDS = Counter('redis_commands_total', 'Redis commands sent, by calling function', ['function', 'command'])
+REDIS_RETRIES = Counter('redis_retries_total', 'Failed writes retried from the background retry queue', ['operation'])
+REDIS_RETRIES_EXHAUSTED = Counter('redis_retries_exhausted_total', 'Operations that failed every retry', ['operation'])
+REDIS_RETRIES_DROPPED = Counter('redis_retries_dropped_total', 'Failed writes dropped because the retry queue was full', ['operation'])
+
+# the data layer function currently running, so commands can be attributed to it
+current_function: ContextVar[str] = ContextVar('current_redis_function', default='other')
+
+
+## 2.1 per function timing ##
+
+def redis_timed(func):
+    name = func.__name__
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        token = current_function.set(name)
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            REDIS_CALL_ERRORS.labels(name).inc()
+            raise
+        finally:
+            REDIS_CALL_SECONDS.labels(name).observe(time.perf_counter() - started)
+            current_function.reset(token)
+    return wrapper
+
+
+## 2.2 command counting clients ##
+
+def count_command(command):
+    REDIS_COMMANDS.labels(current_function.get(), str(command).upper()).inc()
+
+
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        for args, _ in self.command_stack:
+            count_command(args[0])
+        return await super().execute(raise_on_error)
+
+
+class InstrumentedRedis(redis.Redis):
+    async def execute_command(self, *args, **options):
+        count_command(args[0])
+        return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint: str | None = None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+### 3. POSTGRES ###
+
+DB_QUERY_SECONDS = Histogram('db_query_duration_seconds', 'Postgres statement latency by statement type', ['operation'])
+
+# times every statement the engine sends, labelled by its first keyword (SELECT, INSERT...)
+def instrument_engine(engine):
+    sync_engine = getattr(engine, 'sync_engine', engine)
+
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['query_started'].pop()
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'UNKNOWN'
+        DB_QUERY_SECONDS.labels(operation).observe(time.perf_counter() - started)
+
+    @event.listens_for(sync_engine, 'handle_error')
+    def handle_error(context):
+        started = context.connection.info.get('query_started') if context.connection is not None else None
+        if started:
+            started.pop()
+
+    return engine
+
+
+### 4. CACHES AND POOLS ###
+
+NAME_CACHE_LOOKUPS = Counter('name_cache_lookups_total', 'Name lookups by where they were answered (local, redis, miss)',
+                             ['cache', 'result'])
+
+
+# read at scrape time, so the caches and pools do not pay anything per request
+class StateCollector:
+    # names vary with the pools in use, so nothing is declared up front
+    def describe(self):
+        return []
+
+    def collect(self):
+        hits = CounterMetricFamily('local_cache_hits', 'In-process cache hits', labels=['cache'])
+        misses = CounterMetricFamily('local_cache_misses', 'In-process cache misses', labels=['cache'])
+        size = GaugeMetricFamily('local_cache_entries', 'In-process cache entries', labels=['cache'])
+        ratio = GaugeMetricFamily('local_cache_hit_ratio', 'In-process cache hit ratio since start', labels=['cache'])
+        for cache in CACHES:
+            stats = cache.stats()
+            hits.add_metric([cache.name], stats['hits'])
+            misses.add_metric([cache.name], stats['misses'])
+            size.add_metric([cache.name], stats['size'])
+            ratio.add_metric([cache.name], stats['hit_ratio'])
+        yield from (hits, misses, size, ratio)
+
+        # imported here, connections imports this module for the instrumented clients
+        from data.connections import pool_stats
+        pools = pool_stats()
+        gauges = {}
+        for pool_name, stats in [(f'redis_{db}', s) for db, s in pools['redis'].items()] + [('postgres', pools['postgres'])]:
+            for stat, value in stats.items():
+                if isinstance(value, (int, float)):
+                    if stat not in gauges:
+                        gauges[stat] = GaugeMetricFamily(f'connection_pool_{stat}', f'Connection pool {stat.replace("_", " ")}', labels=['pool'])
+                    gauges[stat].add_metric([pool_name], value)
+        yield from gauges.values()
+
+        from data.connections import circuit_stats
+        circuit = GaugeMetricFamily('redis_circuit_state', 'Redis circuit breaker state (0 closed, 1 half open, 2 open)', labels=['node'])
+        opens = CounterMetricFamily('redis_circuit_opens', 'Times the node\'s circuit opened', labels=['node'])
+        rejected = CounterMetricFamily('redis_circuit_rejected', 'Calls failed fast by an open circuit', labels=['node'])
+        for node, stats in circuit_stats().items():
+            circuit.add_metric([node], {'closed': 0, 'half_open': 1, 'open': 2}[stats['state']])
+            opens.add_metric([node], stats['opens'])
+            rejected.add_metric([node], stats['rejected'])
+        yield from (circuit, opens, rejected)
+
+        from data.leaderboard import retry_queue
+        yield GaugeMetricFamily('redis_retry_queue_size', 'Failed redis writes waiting in the retry queue', value=retry_queue.qsize())
+
+        from data.logs import logging_stats
+        stats = logging_stats()
+        if stats:
+            yield GaugeMetricFamily('log_queue_size', 'Log records waiting for the listener thread', value=stats['queued'])
+            yield CounterMetricFamily('log_records_dropped', 'Log records dropped because the log queue was full', value=stats['dropped'])
+
+
+REGISTRY.register(StateCollector())
+
+
+### 5. EXPOSITION ###
+
+def render_metrics() -> tuple[bytes, str]:
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
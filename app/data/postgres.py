@@ -1,27 +1,29 @@
 from api.database import SessionDep
 import logging
 from typing import List 
+from datetime import datetime
 from sqlmodel import select
-from api.models import User
+from sqlalchemy import String, and_, case, cast, func, literal, or_
+from sqlalchemy.orm import aliased
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from api.models import User, Game, Score, BestScore
+from api.schema import Period
+from redis.exceptions import RedisError
+from data.leaderboard import get_player_profiles, set_player_profiles, period_start
 
 
 ## 0.1 logger ##
 
-logging.basicConfig(level=logging.INFO,
-                    format="%(asctime)s - %(levelname)s - %(message)s",
-                    handlers=[
-        logging.StreamHandler(),  # Logs to console
-        logging.FileHandler("postgres.log")  # Logs to file
-    ])
-
 logger = logging.getLogger(__name__)
 
 
 ## 0.1 lookup various users from postgres
-def retrieve_multiple_usernames_pg(list_of_ids : List[str], session):
+async def retrieve_multiple_usernames_pg(list_of_ids : List[str], session):
     # get data from postgres
     try:
-        data = session.exec(select(User).where(User.id.in_(list_of_ids))).all()
+        # ids from redis are strings, asyncpg needs them typed
+        data = (await session.exec(select(User).where(User.id.in_([int(id) for id in list_of_ids])))).all()
     except Exception as e:
         logger.error(f"Failure to read data from db: {e} for users: {list_of_ids}")
         return None
@@ -41,29 +43,182 @@ def retrieve_multiple_usernames_pg(list_of_ids : List[str], session):
     return data
 
 
-# take list of leaders [ids] and return dict with {rank : {username: (username), country: (country), date joined : (date)} 
-def get_player_info(leaders : List[str], session : SessionDep):
-    
-    # get the postgres data
-    leaders_data = retrieve_multiple_usernames_pg(leaders, session)
+# profile fields shown in the top players report
+def player_profile(user: User) -> dict:
+    return {"username": user.username, "country": user.country, "date_joined": user.date_added.isoformat()}
 
-    # return if no data
-    if leaders_data == None:
-        return None
-    
-    # prepare leaders_data
-    data_to_include= {'username', 'country', 'date_added'}
 
-    cleaned_leaders_data = {str(leader.id) : {key: getattr(leader, key) for key in data_to_include} for leader in leaders_data}
-    print(leaders)
-    print('clean data', cleaned_leaders_data)
+# take list of leaders [ids] and return [{rank, username, country, date_joined}] in board order.
+# profiles come from the redis cache, any misses are read with one IN query and cached. leaders with no user row are left out
+async def get_player_info(leaders : List[str], session : SessionDep):
+    try:
+        profiles = await get_player_profiles(leaders)
+    except RedisError as e:
+        logger.error(f"Failed to read player profiles from redis: {e}")
+        profiles = [None] * len(leaders)
+
+    missing = [user_id for user_id, profile in zip(leaders, profiles) if profile is None]
+    if missing:
+        # get the postgres data
+        leaders_data = await retrieve_multiple_usernames_pg(missing, session)
+
+        # return if no data
+        if leaders_data == None:
+            return None
+
+        found = {str(leader.id): player_profile(leader) for leader in leaders_data}
+        try:
+            await set_player_profiles(found)
+        except RedisError as e:
+            logger.error(f"Failed to cache player profiles: {e}")
+        profiles = [profile if profile is not None else found.get(str(user_id)) for user_id, profile in zip(leaders, profiles)]
 
     # add ranks and map data to the correct position as in the ordered redis list
-    ordered_leaders_data =  [
-    {"rank": f"Player #{i + 1}", **cleaned_leaders_data[str(user_id)]}
-    for i, user_id in enumerate(leaders)
-    ]
+    return [{"rank": i + 1, **profile} for i, profile in enumerate(profiles) if profile is not None]
+
+
+### 2. BEST SCORES ###
+
+# BestScore is the all-time board in postgres. every Score insert upserts it in the same transaction,
+# folding the new score in with the game's ScoreMode exactly as the redis submit script does
+
+
+## 2.1 upsert ##
+
+def best_score_upsert(dialect: str, score_mode: str, rows):
+    statement = (sqlite_insert if dialect == 'sqlite' else pg_insert)(BestScore).values(rows)
+    new, old = statement.excluded.score, BestScore.score
+    if score_mode == 'max':
+        kept = case((new > old, new), else_=old)
+    elif score_mode == 'min':
+        kept = case((new < old, new), else_=old)
+    else:
+        kept = new
+    # date_added is when the kept score was set
+    date_added = case((kept == old, BestScore.date_added), else_=statement.excluded.date_added)
+    return statement.on_conflict_do_update(index_elements=['game_id', 'user_id'],
+                                           set_={"score": kept, "date_added": date_added})
+
+
+# rows: {user_id, game_id, score, date_added} dicts in submission order. the caller commits
+async def upsert_best_scores(session, rows):
+    if not rows:
+        return
+    game_ids = {row["game_id"] for row in rows}
+    modes = dict((await session.exec(select(Game.id, Game.score_mode).where(Game.id.in_(game_ids)))).all())
+
+    # an upsert cannot touch the same row twice, so fold repeats of a (game, user) here first
+    best = {}
+    for row in rows:
+        key = (row["game_id"], row["user_id"])
+        mode = modes.get(row["game_id"], 'max')
+        current = best.get(key)
+        if (current is None or mode == 'overwrite'
+                or (mode == 'max' and row["score"] > current["score"])
+                or (mode == 'min' and row["score"] < current["score"])):
+            best[key] = {field: row[field] for field in ('user_id', 'game_id', 'score', 'date_added')}
+
+    by_mode = {}
+    for (game_id, _), row in best.items():
+        by_mode.setdefault(modes.get(game_id, 'max'), []).append(row)
+    dialect = session.get_bind().dialect.name
+    for mode, mode_rows in by_mode.items():
+        await session.execute(best_score_upsert(dialect, mode, mode_rows))
+
+
+## 2.2 folding score rows ##
+
+# each user's board score from the Score table, optionally only rows since a date (the periodic boards)
+def score_board_query(game_id: int, score_mode: str, since: datetime | None = None):
+    conditions = [Score.game_id == game_id]
+    if since is not None:
+        conditions.append(Score.date_added >= since)
+    if score_mode in ('max', 'min'):
+        fold = func.max if score_mode == 'max' else func.min
+        return select(Score.user_id, fold(Score.score).label('score')).where(*conditions).group_by(Score.user_id).subquery()
+    # overwrite keeps each user's latest score
+    latest = select(Score.user_id, Score.score,
+                    func.row_number().over(partition_by=Score.user_id,
+                                           order_by=(Score.date_added.desc(), Score.id.desc())).label('position')
+                    ).where(*conditions).subquery()
+    return select(latest.c.user_id, latest.c.score).where(latest.c.position == 1).subquery()
+
+
+### 3. FALLBACK LEADERBOARD ###
+
+# the redis leaderboard reads answered from postgres, used by the routes while redis is down.
+# results have the same shapes as their data/leaderboard.py counterparts, and ranks are positions in the same order:
+# better scores first (higher, or lower for min games, which redis ranks lowest first), then ties by user id
+# descending as text, the way redis orders members. a rank is one plus the players ahead, counted through
+# ix_bestscore_game_score so only the rows above the user are touched
+
+
+async def game_score_mode(session, game_id: int) -> str:
+    game = await session.get(Game, game_id)
+    return game.score_mode if game is not None else 'max'
+
+
+def board_query(game_id: int, score_mode: str, period: Period | None = None):
+    if period is None or period == Period.all:
+        return select(BestScore.user_id, BestScore.score).where(BestScore.game_id == game_id).subquery()
+    return score_board_query(game_id, score_mode, period_start(period))
+
+
+def member(user_id):
+    return cast(user_id, String)
+
+def board_order(board, score_mode: str):
+    return (board.c.score.asc() if score_mode == 'min' else board.c.score.desc(), member(board.c.user_id).desc())
+
+def ahead_of(board, score, user_id, score_mode: str):
+    better = board.c.score < score if score_mode == 'min' else board.c.score > score
+    return or_(better, and_(board.c.score == score, member(board.c.user_id) > str(user_id)))
+
+
+# [(user_id, score)] for positions start..end, like retrieve_leaders
+async def pg_retrieve_leaders(session, game_id: int, start: int, end: int, period: Period | None = None):
+    score_mode = await game_score_mode(session, game_id)
+    board = board_query(game_id, score_mode, period)
+    query = (select(board.c.user_id, board.c.score)
+             .order_by(*board_order(board, score_mode))
+             .offset(start).limit(end - start + 1))
+    return [(str(user_id), float(score)) for user_id, score in (await session.exec(query)).all()]
+
+
+# (rank, score), or (None, None) if the user has no score, like retrieve_ranking
+async def pg_retrieve_ranking(session, user_id: int, game_id: int, period: Period | None = None):
+    score_mode = await game_score_mode(session, game_id)
+    board = board_query(game_id, score_mode, period)
+    score = (await session.exec(select(board.c.score).where(board.c.user_id == int(user_id)))).first()
+    if score is None:
+        return (None, None)
+    ahead = (await session.exec(select(func.count()).select_from(board).where(ahead_of(board, score, user_id, score_mode)))).one()
+    return (ahead + 1, float(score))
+
+
+# [(game_id, rank, score)] sorted by game id, or None, like user_data_all_games. one query for all the user's games
+async def pg_user_data_all_games(session, user_id: int):
+    other = aliased(BestScore)
+    ahead = (select(func.count()).select_from(other)
+             .where(other.game_id == BestScore.game_id,
+                    or_(and_(Game.score_mode == 'min', other.score < BestScore.score),
+                        and_(Game.score_mode != 'min', other.score > BestScore.score),
+                        and_(other.score == BestScore.score, member(other.user_id) > member(BestScore.user_id))))
+             .scalar_subquery())
+    query = (select(BestScore.game_id, ahead + 1, BestScore.score)
+             .join(Game, Game.id == BestScore.game_id)
+             .where(BestScore.user_id == int(user_id))
+             .order_by(BestScore.game_id))
+    rankings = [(str(game_id), rank, float(score)) for game_id, rank, score in (await session.exec(query)).all()]
+    return rankings or None
 
-    return ordered_leaders_data
 
+## 3.1 backfill ##
 
+# recomputes a game's BestScore rows from the Score table, for databases that predate it
+async def rebuild_best_scores_for_game(session, game_id: int, score_mode: str):
+    await session.execute(BestScore.__table__.delete().where(BestScore.game_id == game_id))
+    board = score_board_query(game_id, score_mode)
+    await session.execute(BestScore.__table__.insert().from_select(
+        ['game_id', 'user_id', 'score', 'date_added'],
+        select(literal(game_id), board.c.user_id, board.c.score, literal(datetime.utcnow()))))
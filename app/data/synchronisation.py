@@ -1,2 +1,424 @@
+import argparse
+import asyncio
+import logging
+import socket
+import time
+from datetime import datetime
+from decouple import config
+from redis.exceptions import RedisError, ResponseError
+from sqlalchemy import insert
+from sqlmodel import select
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError, DataError
+from api.database import async_session
+from api.models import Score, Game
+from data.leaderboard import r_leaderboard, r_user, r_game, SCORE_STREAM, SCORE_STREAM_GROUP, PERIODS, LEADERBOARD_CHANGES_CHANNEL, HISTOGRAM_EDGES_KEY, SCORE_HISTOGRAM_EDGES, DEFAULT_HISTOGRAM_EDGES, leaderboard_key, histogram_key, histogram_bucket, board_score, period_start, user_games_key, version_key, set_game_mode, board_clients, board_index, is_sharded
+from data.leaderboard import USER_NAME_PREFIX, GAME_NAME_PREFIX, name_bucket_key
+from data.postgres import upsert_best_scores, rebuild_best_scores_for_game
+from data.logs import setup_logging
 
 
+# background jobs that keep redis and postgres in step
+# run with: python -m data.synchronisation <command>
+
+
+### 0. Initialization ###
+
+
+## 0.1 logger ##
+
+logger = logging.getLogger(__name__)
+
+
+## 0.2 settings ##
+
+# rows per postgres insert
+FLUSH_BATCH_SIZE = config('FLUSH_BATCH_SIZE', default=500, cast=int)
+# how long a read waits for new entries before looping
+FLUSH_BLOCK_MS = config('FLUSH_BLOCK_MS', default=1000, cast=int)
+# entries left unacked by another consumer for this long are taken over (that consumer is assumed dead)
+FLUSH_CLAIM_IDLE_MS = config('FLUSH_CLAIM_IDLE_MS', default=60000, cast=int)
+# pause after a failed commit before the pending entries are retried
+FLUSH_RETRY_DELAY = config('FLUSH_RETRY_DELAY', default=1.0, cast=float)
+
+# errors caused by the row itself, retrying will not help. anything else (connection loss etc) is retried.
+ROW_ERRORS = (IntegrityError, DataError, KeyError, ValueError)
+
+# games rebuilt at the same time, each holds one postgres connection
+REBUILD_WORKERS = config('REBUILD_WORKERS', default=4, cast=int)
+# rows fetched per cursor round trip and members per ZADD
+REBUILD_CHUNK_SIZE = config('REBUILD_CHUNK_SIZE', default=5000, cast=int)
+
+# rows postgres refuses on their own (e.g. unknown game) are parked here rather than blocking the stream
+SCORE_DEAD_LETTER_STREAM = f'{SCORE_STREAM}:dead'
+
+
+### 1. WRITE-BEHIND FLUSHER ###
+
+# reads the score stream through a consumer group and bulk inserts into Score.
+# entries are only acked after the commit, so a crash leaves them pending and they are re-read on restart.
+# delivery is at-least-once: a crash between commit and ack inserts that batch twice.
+
+
+## 1.1 consumer group ##
+
+async def ensure_consumer_group():
+    try:
+        await r_leaderboard.xgroup_create(SCORE_STREAM, SCORE_STREAM_GROUP, id='0', mkstream=True)
+    except ResponseError as e:
+        # group already exists
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+# moves entries stuck with dead consumers over to this one
+async def claim_stale_entries(consumer: str):
+    start = '0-0'
+    while True:
+        start, claimed, *_ = await r_leaderboard.xautoclaim(SCORE_STREAM, SCORE_STREAM_GROUP, consumer,
+                                                             FLUSH_CLAIM_IDLE_MS, start_id=start, count=FLUSH_BATCH_SIZE)
+        if claimed:
+            logger.info(f'Claimed {len(claimed)} stale score entries for {consumer}')
+        if start == '0-0':
+            return
+
+
+## 1.2 writing a batch ##
+
+def entry_to_row(fields: dict):
+    return {"user_id": int(fields["user_id"]),
+            "game_id": int(fields["game_id"]),
+            "score": float(fields["score"]),
+            "date_added": datetime.fromisoformat(fields["date_added"])}
+
+
+async def insert_rows(rows):
+    async with async_session() as session:
+        await session.execute(insert(Score), rows)
+        await upsert_best_scores(session, rows)
+        await session.commit()
+
+
+# acks and deletes in one go, the stream only holds scores that are not in postgres yet
+async def ack_entries(entry_ids):
+    pipeline = r_leaderboard.pipeline(transaction=True)
+    pipeline.xack(SCORE_STREAM, SCORE_STREAM_GROUP, *entry_ids)
+    pipeline.xdel(SCORE_STREAM, *entry_ids)
+    await pipeline.execute()
+
+
+async def flush_entries(entries):
+    # entries deleted from the stream while pending come back with no fields
+    entry_ids = [entry_id for entry_id, _ in entries]
+    live = [(entry_id, fields) for entry_id, fields in entries if fields]
+
+    flushed = len(live)
+    try:
+        await insert_rows([entry_to_row(fields) for _, fields in live])
+    except ROW_ERRORS as e:
+        # a bad row fails the whole insert, so retry one by one and park the rows that still fail
+        logger.warning(f'Batch insert failed, retrying {len(live)} rows individually: {e}')
+        for entry_id, fields in live:
+            try:
+                await insert_rows([entry_to_row(fields)])
+            except ROW_ERRORS as row_error:
+                logger.error(f'Moving score entry {entry_id} to {SCORE_DEAD_LETTER_STREAM}: {row_error}')
+                flushed -= 1
+                await r_leaderboard.xadd(SCORE_DEAD_LETTER_STREAM, {**fields, "error": str(row_error)[:200]})
+
+    await ack_entries(entry_ids)
+    return flushed
+
+
+## 1.3 main loop ##
+
+async def run_flusher(consumer: str, batch_size: int = FLUSH_BATCH_SIZE, block_ms: int = FLUSH_BLOCK_MS):
+    await ensure_consumer_group()
+    await claim_stale_entries(consumer)
+
+    # '0' re-reads entries delivered to this consumer but never acked, '>' reads new ones
+    read_from = '0'
+    while True:
+        try:
+            response = await r_leaderboard.xreadgroup(SCORE_STREAM_GROUP, consumer, {SCORE_STREAM: read_from},
+                                                      count=batch_size, block=None if read_from == '0' else block_ms)
+            entries = response[0][1] if response else []
+            if not entries:
+                read_from = '>'
+                continue
+
+            flushed = await flush_entries(entries)
+            logger.info(f'Flushed {flushed} scores to postgres')
+
+        except (RedisError, SQLAlchemyError, OSError) as e:
+            # nothing was acked, go back over the pending entries once things recover
+            logger.error(f'Score flush failed, retrying in {FLUSH_RETRY_DELAY}s: {e}')
+            read_from = '0'
+            await asyncio.sleep(FLUSH_RETRY_DELAY)
+
+
+### 2. LEADERBOARD REBUILD ###
+
+# rebuilds the redis boards from the Score table, e.g. after redis was flushed or failed over.
+# each board is loaded into a staging key and swapped in with RENAME, so readers see the old board until the new one is complete.
+# scores submitted while a game is being rebuilt can be lost from redis, run it with submissions paused or replay them afterwards.
+
+
+## 2.1 reading scores ##
+
+# rows for one game ordered by user, so each user's current score is known as soon as the next user starts.
+# memory stays at one cursor chunk whatever the size of the table
+def board_rows_query(game_id: int, since: datetime | None = None):
+    query = select(Score.user_id, Score.score).where(Score.game_id == game_id)
+    if since is not None:
+        query = query.where(Score.date_added >= since)
+    return query.order_by(Score.user_id, Score.date_added, Score.id).execution_options(yield_per=REBUILD_CHUNK_SIZE)
+
+
+# how a user's submissions reduce to their board score for each ScoreMode, matching the submit script
+SCORE_REDUCERS = {
+    'max': max,
+    'min': min,
+    'overwrite': lambda current, new: new,
+}
+
+# yields {user_id: score} chunks from a server-side cursor
+async def stream_board_members(game_id: int, score_mode: str, since: datetime | None = None):
+    reduce_score = SCORE_REDUCERS[score_mode]
+    chunk = {}
+    current_user, current_score = None, None
+    async with async_session() as session:
+        result = await session.stream(board_rows_query(game_id, since))
+        async for user_id, score in result:
+            if user_id != current_user:
+                if current_user is not None:
+                    chunk[current_user] = current_score
+                    if len(chunk) >= REBUILD_CHUNK_SIZE:
+                        yield chunk
+                        chunk = {}
+                current_user, current_score = user_id, score
+            else:
+                current_score = reduce_score(current_score, score)
+    if current_user is not None:
+        chunk[current_user] = current_score
+    if chunk:
+        yield chunk
+
+
+## 2.2 loading a board ##
+
+# a sharded game's members are staged on their own shard. returns the members loaded per board client
+async def load_chunk(staging_key: str, game_id: int, members: dict):
+    clients = board_clients(game_id)
+    staged = [{} for _ in clients]
+    for user_id, score in members.items():
+        staged[board_index(game_id, user_id)][user_id] = score
+
+    pipelines = [client.pipeline(transaction=False) for client in clients]
+    for pipeline, client_members in zip(pipelines, staged):
+        if client_members:
+            pipeline.zadd(staging_key, client_members)
+    # the user's game index always lives on the main node
+    if is_sharded(game_id):
+        pipelines.append(r_leaderboard.pipeline(transaction=False))
+    for user_id in members:
+        pipelines[-1].sadd(user_games_key(user_id), game_id)
+    await asyncio.gather(*(pipeline.execute() for pipeline in pipelines))
+    return [len(client_members) for client_members in staged]
+
+
+# returns the number of members loaded. the all-time board also rebuilds its histogram on the current default edges,
+# counting real scores while the board holds board scores (negated for min games).
+# a sharded game is swapped in shard by shard
+async def rebuild_board(game_id: int, score_mode: str, key: str, since: datetime | None = None, ttl=None,
+                        with_histogram: bool = False):
+    staging_key = f'rebuild:{key}'
+    clients = board_clients(game_id)
+    await asyncio.gather(*(client.delete(staging_key) for client in clients))
+
+    loaded = [0] * len(clients)
+    histograms = [{} for _ in clients]
+    async for members in stream_board_members(game_id, score_mode, since):
+        board_members = {user_id: board_score(score, score_mode) for user_id, score in members.items()}
+        loaded = [total + count for total, count in zip(loaded, await load_chunk(staging_key, game_id, board_members))]
+        if with_histogram:
+            for user_id, score in members.items():
+                histogram = histograms[board_index(game_id, user_id)]
+                bucket = histogram_bucket(DEFAULT_HISTOGRAM_EDGES, score)
+                histogram[bucket] = histogram.get(bucket, 0) + 1
+
+    async def swap(client, count, histogram):
+        pipeline = client.pipeline(transaction=True)
+        if count:
+            pipeline.rename(staging_key, key)
+            if ttl is not None:
+                pipeline.expire(key, ttl)
+        else:
+            # nothing in postgres for this board, an empty sorted set cannot exist in redis
+            pipeline.delete(key)
+        if with_histogram:
+            pipeline.delete(histogram_key(game_id))
+            if histogram:
+                pipeline.hset(histogram_key(game_id), mapping=histogram)
+            pipeline.hset(HISTOGRAM_EDGES_KEY, game_id, SCORE_HISTOGRAM_EDGES)
+        await pipeline.execute()
+
+    await asyncio.gather(*(swap(client, count, histogram) for client, count, histogram in zip(clients, loaded, histograms)))
+
+    # cached pages of the old board must not be served, and live viewers need the new one
+    pipeline = r_leaderboard.pipeline(transaction=True)
+    pipeline.incr(version_key(game_id))
+    pipeline.publish(LEADERBOARD_CHANGES_CHANNEL, game_id)
+    await pipeline.execute()
+    return sum(loaded)
+
+
+# the all-time board and the current bucket of each period
+async def rebuild_game(game_id: int, score_mode: str):
+    started = time.monotonic()
+    await set_game_mode(game_id, score_mode)
+    loaded = await rebuild_board(game_id, score_mode, leaderboard_key(game_id), with_histogram=True)
+    for period, (_, ttl) in PERIODS.items():
+        await rebuild_board(game_id, score_mode, leaderboard_key(game_id, period), period_start(period), ttl)
+    logger.info(f'Rebuilt game {game_id}: {loaded} members in {time.monotonic() - started:.1f}s')
+    return loaded
+
+
+## 2.3 running the rebuild ##
+
+async def rebuild_leaderboards(game_ids: list[int] | None = None, workers: int = REBUILD_WORKERS):
+    async with async_session() as session:
+        query = select(Game.id, Game.score_mode).order_by(Game.id)
+        if game_ids:
+            query = query.where(Game.id.in_(game_ids))
+        game_modes = dict((await session.exec(query)).all())
+    game_ids = list(game_modes)
+
+    semaphore = asyncio.Semaphore(workers)
+    started = time.monotonic()
+    done, members = 0, 0
+
+    async def run(game_id):
+        nonlocal done, members
+        async with semaphore:
+            loaded = await rebuild_game(game_id, game_modes[game_id])
+        done += 1
+        members += loaded
+        elapsed = time.monotonic() - started
+        logger.info(f'Rebuild progress: {done}/{len(game_ids)} games, {members} members, {members / elapsed:.0f} members/s')
+
+    await asyncio.gather(*(run(game_id) for game_id in game_ids))
+    logger.info(f'Rebuild finished: {len(game_ids)} games, {members} members in {time.monotonic() - started:.1f}s')
+
+
+## 2.4 postgres best scores ##
+
+# fills BestScore from the Score table, once for databases created before it and after any manual edit of Score
+async def rebuild_best_scores(game_ids: list[int] | None = None):
+    async with async_session() as session:
+        query = select(Game.id, Game.score_mode).order_by(Game.id)
+        if game_ids:
+            query = query.where(Game.id.in_(game_ids))
+        for game_id, score_mode in (await session.exec(query)).all():
+            await rebuild_best_scores_for_game(session, game_id, score_mode)
+            await session.commit()
+            logger.info(f'Rebuilt best scores for game {game_id}')
+
+
+### 3. NAME CACHE MIGRATION ###
+
+# moves the old one-key-per-id name caches (id -> name strings) into the bucketed hashes and reports the memory used
+# before and after. MEMORY USAGE is summed over every key involved, so the figures cover exactly the migrated names.
+
+MIGRATION_CHUNK_SIZE = 1000
+
+
+async def memory_usage(client, keys):
+    total = 0
+    for i in range(0, len(keys), MIGRATION_CHUNK_SIZE):
+        pipeline = client.pipeline(transaction=False)
+        for key in keys[i:i + MIGRATION_CHUNK_SIZE]:
+            pipeline.memory_usage(key, samples=0)
+        total += sum(usage or 0 for usage in await pipeline.execute())
+    return total
+
+
+async def migrate_chunk(client, prefix: str, keys, delete_old: bool):
+    names = await client.mget(keys)
+    old_bytes = await memory_usage(client, keys)
+
+    pipeline = client.pipeline(transaction=False)
+    for id, name in zip(keys, names):
+        if name is not None:
+            pipeline.hset(name_bucket_key(prefix, id), id, name)
+    if delete_old:
+        pipeline.delete(*keys)
+    await pipeline.execute()
+    return old_bytes, {name_bucket_key(prefix, id) for id in keys}
+
+
+async def migrate_name_cache(client, prefix: str, delete_old: bool = False):
+    old_bytes, migrated, buckets = 0, 0, set()
+    chunk = []
+
+    # the old keys are the bare numeric ids
+    async for key in client.scan_iter(match='[0-9]*', count=MIGRATION_CHUNK_SIZE, _type='string'):
+        if not key.isdigit():
+            continue
+        chunk.append(key)
+        if len(chunk) >= MIGRATION_CHUNK_SIZE:
+            chunk_bytes, chunk_buckets = await migrate_chunk(client, prefix, chunk, delete_old)
+            old_bytes, migrated = old_bytes + chunk_bytes, migrated + len(chunk)
+            buckets |= chunk_buckets
+            chunk = []
+    if chunk:
+        chunk_bytes, chunk_buckets = await migrate_chunk(client, prefix, chunk, delete_old)
+        old_bytes, migrated = old_bytes + chunk_bytes, migrated + len(chunk)
+        buckets |= chunk_buckets
+
+    new_bytes = await memory_usage(client, sorted(buckets))
+    ratio = f'{old_bytes / new_bytes:.1f}x smaller' if new_bytes else 'nothing stored'
+    logger.info(f'{prefix} name cache: {migrated} names, {old_bytes} bytes as keys -> '
+                f'{new_bytes} bytes in {len(buckets)} hashes ({ratio})')
+    return migrated, old_bytes, new_bytes
+
+
+async def migrate_name_caches(delete_old: bool = False):
+    await migrate_name_cache(r_user, USER_NAME_PREFIX, delete_old)
+    await migrate_name_cache(r_game, GAME_NAME_PREFIX, delete_old)
+
+
+### 4. COMMAND LINE ###
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m data.synchronisation')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    flush = commands.add_parser('flush', help='flush write-behind scores from the redis stream to postgres')
+    flush.add_argument('--consumer', default=config('FLUSH_CONSUMER', default=socket.gethostname()))
+    flush.add_argument('--batch-size', type=int, default=FLUSH_BATCH_SIZE)
+    flush.add_argument('--block-ms', type=int, default=FLUSH_BLOCK_MS)
+
+    rebuild = commands.add_parser('rebuild', help='rebuild the redis leaderboards from postgres')
+    rebuild.add_argument('--game', type=int, action='append', dest='games', help='game id to rebuild, repeatable (default all)')
+    rebuild.add_argument('--workers', type=int, default=REBUILD_WORKERS)
+
+    best_scores = commands.add_parser('best-scores', help='rebuild the postgres best score table used while redis is down')
+    best_scores.add_argument('--game', type=int, action='append', dest='games', help='game id to rebuild, repeatable (default all)')
+
+    migrate = commands.add_parser('migrate-name-cache', help='move id -> name keys into bucketed hashes and report memory')
+    migrate.add_argument('--delete-old', action='store_true', help='delete the old keys once copied')
+
+    args = parser.parse_args()
+    setup_logging()
+    if args.command == 'flush':
+        asyncio.run(run_flusher(args.consumer, args.batch_size, args.block_ms))
+    elif args.command == 'rebuild':
+        asyncio.run(rebuild_leaderboards(args.games, args.workers))
+    elif args.command == 'best-scores':
+        asyncio.run(rebuild_best_scores(args.games))
+    elif args.command == 'migrate-name-cache':
+        asyncio.run(migrate_name_caches(args.delete_old))
+
+
+if __name__ == '__main__':
+    main()